@@ -0,0 +1,305 @@
+"""Measure ropemacs commands without emacs
+
+Runs ropemacs commands against synthetic projects using the fake
+`lisp` in `fakelisp` and reports, for each command, the median time
+spent in python, the simulated time spent in lisp round trips and
+the number of round trips::
+
+  python benchmarks/bench.py --sizes 1000,10000,50000
+
+With `--startup`, the time loading ropemacs takes with and without
+`ropemacs-lazy-load` is measured instead, each time in a new python
+process.
+
+Rope and ropemode should be importable; pymacs is not needed.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakelisp
+
+
+COMMON = '''\
+def shared(value):
+    """Return `value` unchanged"""
+    return value
+
+
+class Widget(object):
+    """A widget with a size"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def grow(self, amount):
+        """Return a bigger widget"""
+        return Widget(self.size + amount)
+'''
+
+FUNCTION = '''\
+def function_%(module)d_%(index)d(argument):
+    """Compute value %(index)d"""
+    widget = common.Widget(argument)
+    total = common.shared(widget.size) + %(index)d
+    return widget.grow(total)
+
+'''
+
+COMPLETE = '''\
+def complete_me():
+    widget = common.Widget(1)
+    return widget
+'''
+
+
+def make_project(root, lines, module_lines=500):
+    """Create a project with about `lines` lines in `root`
+
+    The first module, `synth/target.py`, is the one commands are run
+    in; it gets a fifth of the lines.
+    """
+    package = os.path.join(root, 'synth')
+    os.makedirs(package)
+    _write(os.path.join(package, '__init__.py'), '')
+    _write(os.path.join(package, 'common.py'), COMMON)
+    function_lines = FUNCTION.count('\n')
+    sizes = [max(module_lines, lines // 5)]
+    remaining = lines - sizes[0]
+    while remaining > 0:
+        sizes.append(min(module_lines, remaining))
+        remaining -= module_lines
+    for number, size in enumerate(sizes):
+        parts = ['from synth import common\n\n\n']
+        for index in range(max(1, size // function_lines)):
+            parts.append(FUNCTION % {'module': number, 'index': index})
+        name = 'target.py' if number == 0 else 'module_%d.py' % number
+        if number == 0:
+            parts.append(COMPLETE)
+        _write(os.path.join(package, name), ''.join(parts))
+    return os.path.join(package, 'target.py')
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class Session(object):
+    """A ropemacs instance talking to a `fakelisp.FakeLisp`"""
+
+    def __init__(self, root, target, lisp, ropemacs):
+        self.root = root
+        self.target = target
+        self.lisp = lisp
+        self.ropemacs = ropemacs
+        lisp.answers = {'Project not exists': True}
+        ropemacs.open_project(root)
+        # other modules are open, too
+        package = os.path.dirname(target)
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                lisp.visit(os.path.join(package, name))
+        self.buffer = lisp.visit(target)
+
+    def restore(self):
+        """Undo the changes made by the previous command
+
+        Buffer changes are reverted and cached completions dropped.
+        """
+        history = self.ropemacs._interface.project.history
+        while history.undo_list:
+            for resource in history.undo()[0].get_changed_resources():
+                self.lisp.visit(resource.real_path)
+                self.lisp.l_revert_buffer()
+        buffer = self.buffer
+        self.lisp.current = buffer
+        if buffer.modified:
+            # replacing only the changed part keeps the changes
+            # `ropemacs-sync-buffer-changes' tracks small
+            with open(buffer.filename) as f:
+                original = f.read()
+            text = buffer.text
+            start = 0
+            while start < min(len(text), len(original)) and \
+                  text[start] == original[start]:
+                start += 1
+            end = 0
+            while end < min(len(text), len(original)) - start and \
+                  text[-end - 1] == original[-end - 1]:
+                end += 1
+            buffer.replace(start + 1, len(text) - end + 1,
+                           original[start:len(original) - end])
+            buffer.modified = False
+        self.ropemacs._completion_cache.entries.clear()
+
+    def goto(self, text, after=False):
+        offset = self.buffer.text.index(text)
+        if after:
+            offset += len(text)
+        self.lisp.l_goto_char(offset + 1)
+
+    def completions(self):
+        self.goto('return widget\n', after=True)
+        self.lisp.l_goto_char(self.lisp.l_point() - 1)
+        self.lisp.l_insert('.gr')
+        self.ropemacs.completions()
+
+    def capf_narrowing(self):
+        self.goto('return widget\n', after=True)
+        self.lisp.l_goto_char(self.lisp.l_point() - 1)
+        self.lisp.l_insert('.gr')
+        candidates = self.ropemacs.completion_candidates
+        candidates(self.lisp.completion_key('gr'), 'gr')
+        self.lisp.l_insert('o')
+        candidates(self.lisp.completion_key('gro'), 'gro')
+
+    def show_doc(self):
+        self.goto('shared(widget')
+        self.ropemacs.show_doc(None)
+
+    def goto_definition(self):
+        self.goto('shared(widget')
+        self.ropemacs.goto_definition()
+
+    def find_occurrences(self):
+        self.goto('shared(widget')
+        self.lisp.answers['Choose what to do'] = 'search'
+        self.ropemacs.find_occurrences()
+
+    def rename_preview(self):
+        self.goto('shared(widget')
+        self.lisp.answers['New name'] = 'shared_value'
+        self.lisp.answers['Choose what to do'] = 'preview'
+        self.lisp.answers['Do the changes?'] = False
+        self.ropemacs.rename(None)
+
+    def rename_apply(self):
+        self.goto('shared(widget')
+        self.lisp.answers['New name'] = 'shared_value'
+        self.lisp.answers['Choose what to do'] = 'perform'
+        self.ropemacs.rename(None)
+
+    def find_file(self):
+        self.lisp.answers['Rope Find File'] = 'module_1.py<synth'
+        self.ropemacs.find_file(None)
+
+SCENARIOS = ['completions', 'capf_narrowing', 'show_doc', 'goto_definition',
+             'find_occurrences', 'rename_preview', 'rename_apply',
+             'find_file']
+
+
+def run(session, scenario, repeat):
+    """Return the medians of python time, lisp time and lisp calls"""
+    lisp = session.lisp
+    samples = []
+    for i in range(repeat):
+        session.restore()
+        lisp.reset()
+        start = time.time()
+        getattr(session, scenario)()
+        total = time.time() - start
+        samples.append((total - lisp.fake_time, lisp.ipc_time, lisp.calls,
+                        lisp.chars))
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def measure_startup(lisp):
+    """Load ropemacs and print python time, lisp time and lisp calls"""
+    start = time.time()
+    import ropemacs
+    lisp.module = ropemacs
+    ropemacs._load_ropemacs()
+    total = time.time() - start
+    print(json.dumps([total - lisp.fake_time, lisp.ipc_time, lisp.calls,
+                      lisp.chars]))
+
+
+def startup(options):
+    """Report the medians of loading ropemacs in new processes"""
+    print('%-20s %10s %10s %10s %7s %9s' % (
+        'Startup', 'Total ms', 'Python ms', 'Lisp ms', 'Calls', 'Chars'))
+    for lazy in ('nil', 't'):
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--rtt', str(options.rtt),
+                   '--char-cost', str(options.char_cost),
+                   '--set', 'ropemacs-lazy-load=' + lazy,
+                   '--startup-child']
+        for setting in options.set:
+            command.extend(['--set', setting])
+        samples = []
+        for i in range(options.repeat):
+            output = subprocess.check_output(command)
+            samples.append(json.loads(output.decode().splitlines()[-1]))
+        samples.sort()
+        python, ipc, calls, chars = samples[len(samples) // 2]
+        print('%-20s %10.1f %10.1f %10.1f %7d %9d' % (
+            'ropemacs-lazy-load=' + lazy, (python + ipc) * 1000,
+            python * 1000, ipc * 1000, calls, chars))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        help='comma separated project sizes in lines')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--rtt', type=float, default=0.0005,
+                        help='the cost of a lisp round trip in seconds')
+    parser.add_argument('--char-cost', type=float, default=1e-7,
+                        help='the cost of transferring a character')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='VARIABLE=VALUE',
+                        help='set a ropemacs variable, like '
+                        'ropemacs-sync-buffer-changes=t')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure loading ropemacs instead')
+    parser.add_argument('--startup-child', action='store_true',
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    if options.startup:
+        startup(options)
+        return
+
+    lisp = fakelisp.install(rtt=options.rtt, char_cost=options.char_cost)
+    for setting in options.set:
+        name, value = setting.split('=', 1)
+        lisp.variables[name] = lisp.eval(fakelisp.read_all(value)[0], {})
+    if options.startup_child:
+        measure_startup(lisp)
+        return
+    import ropemacs
+    lisp.module = ropemacs
+    ropemacs._load_ropemacs()
+    # what enabling `ropemacs-mode' does when loading is deferred
+    ropemacs.load_interface()
+
+    print('%-7s %-18s %10s %10s %10s %7s %9s' % (
+        'Lines', 'Command', 'Total ms', 'Python ms', 'Lisp ms', 'Calls',
+        'Chars'))
+    for size in [int(size) for size in options.sizes.split(',')]:
+        root = tempfile.mkdtemp(prefix='ropemacs-bench-')
+        try:
+            target = make_project(root, size)
+            session = Session(root, target, lisp, ropemacs)
+            for scenario in options.scenarios.split(','):
+                python, ipc, calls, chars = run(session, scenario,
+                                                options.repeat)
+                print('%-7d %-18s %10.1f %10.1f %10.1f %7d %9d' % (
+                    size, scenario, (python + ipc) * 1000, python * 1000,
+                    ipc * 1000, calls, chars))
+            ropemacs.close_project()
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,33 @@
 """ropemacs, an emacs mode for using rope refactoring library"""
+import array
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import os
+import pickle
+import queue
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import traceback
 from os.path import join
 
-import ropemode.decorators
 import ropemode.environment
-import ropemode.interface
-from Pymacs import lisp
-from rope.base import utils
+
+from ropemacs import _workers
+try:
+    from Pymacs import lisp
+except ImportError:
+    # in the worker processes of `_worker_pool()`, which do not use it
+    lisp = None
 
 
 class LispUtils(ropemode.environment.Environment):
@@ -48,10 +69,9 @@ class LispUtils(ropemode.environment.Environment):
         return self.path_on_python_host(result)
 
     def path_on_python_host(self, path_on_lisp_host):
-        path_on_python_host = None
-        if path_on_lisp_host:
-            path_on_python_host = lisp.file_remote_p(path_on_lisp_host, lisp.localname)
-        return path_on_python_host or path_on_lisp_host
+        if not path_on_lisp_host:
+            return path_on_lisp_host
+        return _paths.on_python_host([path_on_lisp_host])[0]
 
     def message(self, msg):
         message(msg)
@@ -72,23 +92,30 @@ class LispUtils(ropemode.environment.Environment):
         return lisp.point() - 1
 
     def get_text(self):
-        end = lisp.buffer_size() + 1
-        old_min = lisp.point_min()
-        old_max = lisp.point_max()
-        narrowed = (old_min != 1 or old_max != end)
-        if narrowed:
-            lisp.narrow_to_region(1, lisp.buffer_size() + 1)
-        try:
-            return lisp.buffer_string()
-        finally:
-            if narrowed:
-                lisp.narrow_to_region(old_min, old_max)
+        if self.get('sync_buffer_changes'):
+            return _shadows.text()
+        if _bulk.size is not None:
+            filename = _bulk.filename()
+            return _bulk.text(lisp.ropemacs__bulk_text(filename), filename)
+        batch = _LispBatch()
+        old_min = batch.call('point-min')
+        old_max = batch.call('point-max')
+        narrowed = batch.call('buffer-narrowed-p')
+        batch.call('widen')
+        text = batch.call('buffer-string')
+        batch.call('narrow-to-region', old_min, old_max, when=narrowed)
+        batch.send()
+        return text.value
 
     def get_region(self):
-        offset1 = self.get_offset()
-        lisp.exchange_point_and_mark()
-        offset2 = self.get_offset()
-        lisp.exchange_point_and_mark()
+        batch = _LispBatch()
+        point1 = batch.call('point')
+        batch.call('exchange-point-and-mark')
+        point2 = batch.call('point')
+        batch.call('exchange-point-and-mark')
+        batch.send()
+        offset1 = point1.value - 1
+        offset2 = point2.value - 1
         return min(offset1, offset2), max(offset1, offset2)
 
     def filename(self):
@@ -114,46 +141,40 @@ class LispUtils(ropemode.environment.Environment):
         lisp.delete_region(start, end)
 
     def filenames(self):
-        result = []
-        for buffer in lisp.buffer_list():
-            filename = lisp.buffer_file_name(buffer)
-            if filename:
-                result.append(filename)
-        return result
+        batch = _LispBatch()
+        filenames = batch.call('mapcar', lisp['buffer-file-name'],
+                               batch.call('buffer-list'))
+        batch.send()
+        return [filename for filename in filenames.value or [] if filename]
 
     def save_files(self, filenames):
-        ask = self.get('confirm_saving')
-        initial = lisp.current_buffer()
-        for filename in filenames:
-            buffer = lisp.find_buffer_visiting(filename)
-            if buffer:
-                if lisp.buffer_modified_p(buffer):
-                    if not ask or lisp.y_or_n_p('Save %s buffer?' % filename):
-                        lisp.set_buffer(buffer)
-                        lisp.save_buffer()
-        lisp.set_buffer(initial)
-
-    def reload_files(self, filenames, moves={}):
-        if self.filename() in moves:
-            initial = None
-        else:
-            initial = lisp.current_buffer()
-        for filename in filenames:
-            buffer = lisp.find_buffer_visiting(self.path_on_lisp_host(filename))
-            if buffer:
-                if filename in moves:
-                    lisp.kill_buffer(buffer)
-                    lisp.find_file(moves[filename])
-                else:
-                    lisp.set_buffer(buffer)
-                    lisp.revert_buffer(False, True)
-        if initial is not None:
-            lisp.set_buffer(initial)
+        lisp.ropemacs__save_buffers(filenames)
+
+    def reload_files(self, filenames, moves={}, contents={}):
+        """Update the buffers visiting `filenames` after rope changed them
+
+        Buffers of the files in `contents`, a dict of filenames to
+        their new text, are changed in place; others are reverted.
+        """
+        paths = self._paths_on_lisp_host(list(filenames) + list(moves.values()))
+        visited = lisp.ropemacs__visited_files(paths[:len(filenames)]) or []
+        newnames = dict(zip(moves.values(), paths[len(filenames):]))
+        updates = []
+        for filename, path in zip(filenames, paths):
+            if path not in visited:
+                continue
+            if filename in moves:
+                updates.append([path, None, newnames[moves[filename]]])
+            else:
+                updates.append([path, contents.get(filename), None])
+        if updates:
+            lisp.ropemacs__reload_buffers(updates)
 
     def path_on_lisp_host(self, path_on_python_host):
-        default_directory = lisp['default-directory'].value()
-        path = lisp.file_remote_p(default_directory)
-        return join((path or default_directory) , path_on_python_host)
+        return self._paths_on_lisp_host([path_on_python_host])[0]
+
+    def _paths_on_lisp_host(self, paths_on_python_host):
+        return _paths.on_lisp_host(paths_on_python_host)
 
     def find_file(self, filename, readonly=False, other=False):
         filename = self.path_on_lisp_host(filename)
@@ -170,34 +191,39 @@ class LispUtils(ropemode.environment.Environment):
 
         `window` can be one of `None`, 'current' or 'other'.
         """
-        new_buffer = lisp.get_buffer_create(name)
-        lisp.set_buffer(new_buffer)
-        lisp.toggle_read_only(-1)
-        lisp.erase_buffer()
+        batch = _LispBatch()
+        new_buffer = batch.call('get-buffer-create', name)
+        batch.call('set-buffer', new_buffer)
+        batch.call('toggle-read-only', -1)
+        batch.call('erase-buffer')
         if contents or empty_goto:
-            lisp.insert(contents)
+            batch.call('insert', _bulk.argument(batch, contents))
             for mode in modes:
-                lisp[mode + '-mode']()
-            lisp.buffer_disable_undo(new_buffer)
-            lisp.toggle_read_only(1)
+                batch.call(mode + '-mode')
+            batch.call('buffer-disable-undo', new_buffer)
+            batch.call('toggle-read-only', 1)
             if switch:
                 if window == 'current':
-                    lisp.switch_to_buffer(new_buffer)
+                    batch.call('switch-to-buffer', new_buffer)
                 else:
-                    lisp.switch_to_buffer_other_window(new_buffer)
-                lisp.goto_char(lisp.point_min())
+                    batch.call('switch-to-buffer-other-window', new_buffer)
+                batch.call('goto-char', batch.call('point-min'))
             elif window == 'other':
                 if self.get("use_pop_to_buffer"):
-                    lisp.pop_to_buffer(new_buffer)
-                    lisp.goto_char(lisp.point_min())
+                    batch.call('pop-to-buffer', new_buffer)
+                    batch.call('goto-char', batch.call('point-min'))
                 else:
-                    new_window = lisp.display_buffer(new_buffer)
-                    lisp.set_window_point(new_window, lisp.point_min())
-                    if (fit_lines
-                        and lisp.fboundp(lisp['fit-window-to-buffer'])):
-                        lisp.fit_window_to_buffer(new_window, fit_lines)
-                        lisp.bury_buffer(new_buffer)
-        return new_buffer
+                    new_window = batch.call('display-buffer', new_buffer)
+                    batch.call('set-window-point', new_window,
+                               batch.call('point-min'))
+                    if fit_lines:
+                        fits = batch.call('fboundp',
+                                          lisp['fit-window-to-buffer'])
+                        batch.call('fit-window-to-buffer', new_window,
+                                   fit_lines, when=fits)
+                        batch.call('bury-buffer', new_buffer, when=fits)
+        batch.send()
+        return new_buffer.value
 
     def _hide_buffer(self, name, delete=True):
         buffer = lisp.get_buffer(name)
@@ -253,44 +279,48 @@ the rope-marker-ring")
         return lisp.prefix_numeric_value(prefix)
 
     def read_line_from_file(self, filename, lineno):
-        with open(filename) as f:
-            for i, line in enumerate(f):
-                if i+1 == lineno:
-                    return line
-
-        return "" # If lineno goes beyond the end of the file
+        # returns "" if lineno goes beyond the end of the file
+        return _line_indexes.get(filename).line(lineno)
 
     def show_occurrences(self, locations):
-        buffer = self._make_buffer('*rope-occurrences*', "", switch=False)
-        lisp.set_buffer(buffer)
-        lisp.toggle_read_only(0)
-
-        trunc_length = len(lisp.rope_get_project_root())
-
-        lisp.insert('List of occurrences:\n')
-        for location in locations:
-            code_line = self.read_line_from_file(location.filename, location.lineno).rstrip()
-            filename = location.filename[trunc_length:]
-            lineno = str(location.lineno)
-            offset = str(location.offset)
-
-            lisp.insert(filename + ":" + lineno + ":" + code_line + " " + offset)
-
-            beginning = lisp.line_beginning_position()
-            end = beginning + len(filename)
+        writer = self._occurrences_writer()
+        self._write_occurrences(writer, locations)
+        writer.flush()
 
-            lisp.add_text_properties(beginning, end, [lisp.face, lisp.button])
-            lisp.add_text_properties(beginning, end, [lisp.mouse_face, lisp.highlight,
-                                                      lisp.help_echo, "mouse-2: visit this file in other window"])
-
-            lisp.insert("\n")
-
-        lisp.toggle_read_only(1)
-
-        lisp.set(lisp["next-error-function"], lisp.rope_occurrences_next)
-        lisp.local_set_key('\r', lisp.rope_occurrences_goto)
-        lisp.local_set_key((lisp.mouse_1,), lisp.rope_occurrences_goto)
-        lisp.local_set_key('q', lisp.delete_window)
+    def _occurrences_writer(self):
+        """Prepare `*rope-occurrences*` and return its writer"""
+        buffer = self._make_buffer('*rope-occurrences*', "", switch=False)
+        batch = _LispBatch()
+        batch.call('set-buffer', buffer)
+        batch.call('set', lisp["next-error-function"],
+                   lisp['ropemacs--occurrences-next'])
+        batch.call('local-set-key', '\r', lisp['ropemacs--occurrences-goto'])
+        batch.call('local-set-key', (lisp.mouse_1,),
+                   lisp['ropemacs--occurrences-goto'])
+        batch.call('local-set-key', 'q', lisp.delete_window)
+        root = batch.call('rope-get-project-root')
+        batch.send()
+
+        writer = _OccurrencesWriter(buffer)
+        writer.root_length = len(root.value)
+        writer.write('List of occurrences:\n')
+        return writer
+
+    def _write_occurrences(self, writer, locations):
+        groups = [(path, list(group)) for path, group in itertools.groupby(
+            locations, lambda location: location.filename)]
+        visited = self._paths_on_lisp_host([path for path, group in groups])
+        for (path, group), lisp_path in zip(groups, visited):
+            lines = _line_indexes.get(path)
+            filename = path[writer.root_length:]
+            for location in group:
+                code_line = lines.line(location.lineno).rstrip()
+                lineno = str(location.lineno)
+                offset = str(location.offset)
+
+                writer.write(filename + ":" + lineno + ":" + code_line +
+                             " " + offset + "\n", len(filename),
+                             (lisp_path, location.offset))
 
 
     def show_doc(self, docs, altview=False):
@@ -308,30 +338,41 @@ the rope-marker-ring")
             self.message(docs)
 
     def preview_changes(self, diffs):
-        self._make_buffer('*rope-preview*', diffs, switch=True,
-                          modes=['diff'], window='current')
+        global _preview
+        size = self.get('lazy_preview_size')
+        if size is None or len(diffs) < size:
+            self._make_buffer('*rope-preview*', diffs, switch=True,
+                              modes=['diff'], window='current')
+        else:
+            _preview = _DiffSections(diffs)
+            lisp.ropemacs__preview_sections(_preview.header(),
+                                            _preview.summary())
         try:
             return self.yes_or_no('Do the changes? ')
         finally:
+            _preview = None
             self._hide_buffer('*rope-preview*', delete=False)
 
     def local_command(self, name, callback, key=None, prefix=False):
-        globals()[name] = callback
+        callback = _profiled(name, _serialized(callback))
         self._set_interaction(callback, prefix)
+        _export(name, callback)
         if self.local_prefix and key:
             key = self._key_sequence(self.local_prefix + ' ' + key)
             self._bind_local(_lisp_name(name), key)
 
     def _bind_local(self, name, key):
-        lisp('(define-key ropemacs-local-keymap "%s" \'%s)' %
-             (self._key_sequence(key), name))
+        _key_bindings.add('(define-key ropemacs-local-keymap %s \'%s)' %
+                          (_lisp_string(self._key_sequence(key)), name))
 
     def global_command(self, name, callback, key=None, prefix=False):
-        globals()[name] = callback
+        callback = _profiled(name, _serialized(callback))
         self._set_interaction(callback, prefix)
+        _export(name, callback)
         if self.global_prefix and key:
             key = self._key_sequence(self.global_prefix + ' ' + key)
-            lisp.global_set_key(key, lisp[_lisp_name(name)])
+            _key_bindings.add('(global-set-key %s \'%s)' %
+                              (_lisp_string(key), _lisp_name(name)))
 
     def _key_sequence(self, sequence):
         result = []
@@ -363,16 +404,15 @@ the rope-marker-ring")
         mapping = {'before_save': 'before-save-hook',
                    'after_save': 'after-save-hook',
                    'exit': 'kill-emacs-hook'}
-        globals()[name] = callback
+        callback = _profiled(name, _serialized(callback))
+        _export(name, callback)
         lisp.add_hook(lisp[mapping[hook]], lisp[_lisp_name(name)])
 
-    @property
-    @utils.saveit
+    @functools.cached_property
     def global_prefix(self):
         return self.get('global_prefix')
 
-    @property
-    @utils.saveit
+    @functools.cached_property
     def local_prefix(self):
         return self.get('local_prefix')
 
@@ -380,6 +420,1661 @@ the rope-marker-ring")
 def _lisp_name(name):
     return 'rope-' + name.replace('_', '-')
 
+
+def _export(name, callback):
+    """Make `callback` the ropemacs function `name`
+
+    Pymacs defines lisp functions for the functions of this module
+    when loading it; those exported later, when `ropemacs-lazy-load'
+    defers defining the commands, are defined by `load_interface()`.
+    """
+    globals()[name] = callback
+    _exported.append(name)
+
+_exported = []
+
+
+def _decorated(decorator, *args, **kwds):
+    """Mark a method to be decorated with a `ropemode.decorators` one
+
+    `ropemode.decorators` imports rope; the methods of ropemacs mixins
+    are decorated when `load_interface()` imports it.
+    """
+    def mark(func):
+        func.decorator = (decorator, args, kwds)
+        return func
+    return mark
+
+
+def _lisp_string(sequence):
+    """Return a lisp string literal of a key sequence"""
+    result = []
+    for char in sequence:
+        code = ord(char)
+        if char in '"\\':
+            result.append('\\' + char)
+        elif 1 <= code <= 26:
+            result.append('\\C-' + chr(code + 96))
+        elif code < 32:
+            # `\C-` of these characters reads as something else
+            result.append('\\%03o' % code)
+        elif 0x80 <= code < 0x100:
+            result.append('\\M-' + _lisp_string(chr(code - 0x80))[1:-1])
+        else:
+            result.append(char)
+    return '"%s"' % ''.join(result)
+
+
+class _KeyBindings(object):
+    """Send key bindings to emacs in one call and cache them
+
+    While collecting, bindings are gathered and evaluated together;
+    they are saved in a byte-compiled file in `user-emacs-directory`
+    named after ropemacs and ropemode versions and the variables that
+    affect the bindings, so later sessions load that file instead.
+    """
+
+    def __init__(self):
+        self.forms = None
+        self.cached = False
+
+    @contextlib.contextmanager
+    def collect(self, env, part):
+        if self.forms is not None:
+            yield
+            return
+        name = self._filename(env, part)
+        self.cached = bool(lisp.ropemacs__load_key_bindings(name))
+        self.forms = []
+        try:
+            yield
+        finally:
+            forms, self.forms = self.forms, None
+            if forms and not self.cached:
+                lisp.ropemacs__save_key_bindings(name, '\n'.join(forms))
+
+    def add(self, form):
+        if self.forms is None:
+            lisp(form)
+        elif not self.cached:
+            self.forms.append(form)
+
+    def _filename(self, env, part):
+        from importlib import metadata
+        versions = []
+        for package in ('ropemacs', 'ropemode'):
+            try:
+                versions.append(metadata.version(package))
+            except metadata.PackageNotFoundError:
+                versions.append(None)
+        key = repr((part, versions, os.path.getmtime(__file__),
+                    env.local_prefix, env.global_prefix,
+                    env.get('enable_shortcuts'), env.get('lazy_load')))
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+        return 'ropemacs-keys-%s-%s' % (part, digest)
+
+_key_bindings = _KeyBindings()
+
+
+# held while rope is used, so that commands and background jobs do
+# not use the project at the same time
+_rope_lock = threading.RLock()
+# the number of `_serialized()` functions running
+_running = 0
+
+def _serialized(callback):
+    @functools.wraps(callback)
+    def newfunc(*args, **kwds):
+        global _running
+        try:
+            with _rope_lock:
+                _running += 1
+                try:
+                    return callback(*args, **kwds)
+                finally:
+                    _running -= 1
+        finally:
+            _between_commands()
+    return newfunc
+
+
+def _between_commands():
+    """Trim the memory rope uses if no command is running"""
+    with _rope_lock:
+        if _running == 0 and _interface is not None and \
+           _interface.memory is not None:
+            _interface.memory.trim()
+
+
+def _profiled(name, callback):
+    if _profiler is None:
+        return callback
+    @functools.wraps(callback)
+    def newfunc(*args, **kwds):
+        with _profiler.measure(name):
+            return callback(*args, **kwds)
+    return newfunc
+
+
+class _Profiler(object):
+    """Record the time ropemacs commands take
+
+    For each command the total time, the time spent waiting for lisp
+    calls and the number of lisp calls are recorded; lisp calls are
+    counted by replacing `lisp` with a `_ProfilingLisp`.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = {}
+        self.lisp_time = 0.0
+        self.lisp_calls = 0
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        lisp_time = self.lisp_time
+        lisp_calls = self.lisp_calls
+        start = time.time()
+        try:
+            yield
+        finally:
+            sample = (time.time() - start, self.lisp_time - lisp_time,
+                      self.lisp_calls - lisp_calls)
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.size)
+            self.samples[name].append(sample)
+
+    def lisp_call(self, function, *args):
+        start = time.time()
+        try:
+            return function(*_unwrap_lisp(args))
+        finally:
+            self.lisp_time += time.time() - start
+            self.lisp_calls += 1
+
+    def report(self):
+        lines = ['%-32s %6s  %-20s  %-20s  %-13s' %
+                 ('Command', 'Count', 'Total ms p50/90/99',
+                  'Lisp ms p50/90/99', 'Calls p50/max')]
+        for name in sorted(self.samples):
+            samples = self.samples[name]
+            totals = sorted(sample[0] * 1000 for sample in samples)
+            lisps = sorted(sample[1] * 1000 for sample in samples)
+            calls = sorted(sample[2] for sample in samples)
+            lines.append('%-32s %6d  %-20s  %-20s  %-13s' % (
+                _lisp_name(name), len(samples), _percentiles(totals),
+                _percentiles(lisps),
+                '%d/%d' % (_percentile(calls, 50), calls[-1])))
+        return '\n'.join(lines) + '\n'
+
+def _percentile(values, percent):
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+def _percentiles(values):
+    return '/'.join('%.0f' % _percentile(values, percent)
+                    for percent in (50, 90, 99))
+
+def _unwrap_lisp(value):
+    if isinstance(value, _ProfilingSymbol):
+        return value.symbol
+    if isinstance(value, list):
+        return [_unwrap_lisp(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_unwrap_lisp(item) for item in value)
+    return value
+
+
+class _ProfilingLisp(object):
+    """A stand-in for pymacs' `lisp` that reports calls to a `_Profiler`"""
+
+    def __init__(self, lisp, profiler):
+        self.lisp = lisp
+        self.profiler = profiler
+
+    def __call__(self, *args):
+        return self.profiler.lisp_call(self.lisp, *args)
+
+    def __getattr__(self, name):
+        return _ProfilingSymbol(getattr(self.lisp, name), self.profiler)
+
+    def __getitem__(self, name):
+        return _ProfilingSymbol(self.lisp[name], self.profiler)
+
+
+class _ProfilingSymbol(object):
+    """A lisp symbol whose calls are reported to a `_Profiler`
+
+    `_Profiler.lisp_call()` replaces these with the actual symbols in
+    arguments.
+    """
+
+    def __init__(self, symbol, profiler):
+        self.symbol = symbol
+        self.profiler = profiler
+
+    def __call__(self, *args):
+        return self.profiler.lisp_call(self.symbol, *args)
+
+    def value(self):
+        return self.profiler.lisp_call(self.symbol.value)
+
+    def set(self, value):
+        return self.profiler.lisp_call(self.symbol.set, value)
+
+    def __getattr__(self, name):
+        return getattr(self.symbol, name)
+
+
+class _CompletionJob(object):
+    """The information needed for computing completions in background
+
+    Everything that needs emacs is collected when the job is created,
+    with `_rope_lock` held; `run()` only uses rope.  The job stands in for both the interface
+    and the environment of `ropemode.interface._CodeAssist`, so that
+    completions are computed like those of `rope-completions`.
+    """
+
+    def __init__(self, id, env, key, prefix):
+        self.id = id
+        self.key = key
+        self.prefix = prefix
+        self.env = env
+        self.project = _interface.project
+        self.resource = _interface.resource
+        self.autoimport = _interface.autoimport
+        self.source = _interface._get_text()
+        self.offset = env.get_offset()
+        self.options = {'codeassist_maxfixes': env.get('codeassist_maxfixes'),
+                        'sorted_completions': env.get('sorted_completions',
+                                                      True)}
+
+    def run(self):
+        import ropemode.interface
+        self.project.validate(self.project.root)
+        proposals = ropemode.interface._CodeAssist(
+            self, self)._calculate_proposals()
+        return _Completions(self.prefix, proposals, self.env)
+
+    def _check_project(self):
+        pass
+
+    def _get_text(self):
+        return self.source
+
+    def get_offset(self):
+        return self.offset
+
+    def get(self, name, default=None):
+        return self.options.get(name, default)
+
+
+class _Completions(object):
+    """The proposals rope has computed for a prefix
+
+    The documentation and the definition location of proposals are
+    computed when asked for and remembered.
+    """
+
+    def __init__(self, prefix, proposals, env):
+        self.prefix = prefix
+        self.names = []
+        self.proposals = {}
+        for proposal in proposals:
+            name = env._completion_text(proposal)
+            self.names.append(name)
+            self.proposals.setdefault(name, proposal)
+        self.docs = {}
+        self.locations = {}
+
+    def filter(self, prefix):
+        return [name for name in self.names if name.startswith(prefix)]
+
+    def doc(self, name):
+        if name not in self.docs:
+            self.docs[name] = self.proposals[name].get_doc()
+        return self.docs[name]
+
+    def location(self, name):
+        if name not in self.locations:
+            self.locations[name] = self._location(self.proposals[name])
+        return self.locations[name]
+
+    def _location(self, proposal):
+        if proposal.pyname is None:
+            return None
+        module, lineno = proposal.pyname.get_definition_location()
+        if module is None or module.get_resource() is None:
+            return None
+        return [str(module.get_resource().real_path), lineno]
+
+
+class _CompletionCache(object):
+    """Recently computed completions
+
+    Completions are kept with the prefix they were computed for and
+    can be reused for longer prefixes by filtering them.  The keys
+    identify the text around the prefix; see `ropemacs--completion-key'.
+    `last` is the `_Completions` most recently returned.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last = None
+
+    def get(self, key, prefix):
+        """Return the completions of `prefix` or `None` if not cached"""
+        with self.lock:
+            completions = self.entries.get(key)
+            if completions is None or \
+               not prefix.startswith(completions.prefix):
+                return None
+            self.entries.move_to_end(key)
+            self.last = completions
+        return completions.filter(prefix)
+
+    def put(self, key, completions):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = completions
+            self.last = completions
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_completion_cache = _CompletionCache()
+
+
+class _AsyncCompletions(object):
+    """Compute completions in a worker thread
+
+    Only the result of the latest job is kept; older jobs are skipped
+    or their results dropped.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.latest = 0
+        self.results = {}
+        self.thread = None
+
+    def start(self, env, key, prefix):
+        self.latest += 1
+        completions = _completion_cache.get(key, prefix)
+        if completions is not None:
+            self.results = {self.latest: (completions, None)}
+            return self.latest
+        with _rope_lock:
+            if _interface.project is None:
+                _interface._check_project()
+            job = _CompletionJob(self.latest, env, key, prefix)
+        self.jobs.put(job)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work)
+            self.thread.daemon = True
+            self.thread.start()
+        return self.latest
+
+    def poll(self, id):
+        if id in self.results:
+            completions, error = self.results.pop(id)
+            if error is not None:
+                import ropemode.decorators
+                ropemode.decorators.logger(error, error.splitlines()[-1])
+            return [True, completions]
+        if id != self.latest:
+            return None
+        return [False, None]
+
+    def _work(self):
+        from rope.base import exceptions
+        while True:
+            job = self.jobs.get()
+            if job.id != self.latest:
+                continue
+            completions = []
+            error = None
+            with _rope_lock:
+                try:
+                    result = job.run()
+                    _completion_cache.put(job.key, result)
+                    completions = result.filter(job.prefix)
+                except exceptions.RopeError:
+                    pass
+                except Exception:
+                    error = traceback.format_exc()
+            if job.id == self.latest:
+                self.results = {job.id: (completions, error)}
+
+_async_completions = _AsyncCompletions()
+
+
+class _PathTranslator(object):
+    """Translate file names between emacs and python hosts
+
+    Over TRAMP, emacs names the files python sees with a remote
+    prefix, like `/ssh:host:`.  The prefix depends only on the
+    leading part of a name, so it is kept for each folder whose
+    files have been translated, and `file-remote-p` is asked only
+    about new folders, for all of them in one call.  Translating
+    to emacs uses the prefix of `default-directory`, read along with
+    its prefix in one call.
+    """
+
+    def __init__(self):
+        self.prefixes = {}
+
+    def on_python_host(self, paths):
+        folders = [os.path.dirname(path) + '/' for path in paths]
+        unknown = sorted(set(folders) - set(self.prefixes))
+        if unknown:
+            batch = _LispBatch()
+            prefixes = batch.call('mapcar', lisp['file-remote-p'], unknown)
+            batch.send()
+            self.prefixes.update(zip(unknown, prefixes.value))
+        return [path[len(self.prefixes[folder] or ''):]
+                for path, folder in zip(paths, folders)]
+
+    def on_lisp_host(self, paths):
+        batch = _LispBatch()
+        directory = batch.call('symbol-value', lisp['default-directory'])
+        prefix = batch.call('file-remote-p', directory)
+        batch.send()
+        self.prefixes[directory.value] = prefix.value
+        if prefix.value:
+            return [prefix.value + path if os.path.isabs(path)
+                    else join(directory.value, path) for path in paths]
+        return [join(directory.value, path) for path in paths]
+
+_paths = _PathTranslator()
+
+
+class _LispBatch(object):
+    """Send a sequence of lisp calls in one round trip
+
+    `call()` returns a `_LispRef` for the result of each call; these
+    references can be passed as arguments to later calls and hold
+    the results in their `value` attribute after `send()`, unless
+    `result` is false.  Other arguments are transferred by pymacs as
+    usual.
+    """
+
+    def __init__(self):
+        self.forms = []
+        self.args = []
+        self.refs = []
+
+    def call(self, function, *args, **kwds):
+        """Call lisp `function`; if `when` is given, only if it is non-nil
+
+        If `result` is false, the result is not sent back to python.
+        """
+        form = '(%s%s)' % (function,
+                           ''.join(' ' + self._arg(arg) for arg in args))
+        when = kwds.get('when')
+        if when is not None:
+            form = '(and %s %s)' % (self._arg(when), form)
+        ref = _LispRef('r%d' % len(self.refs), kwds.get('result', True))
+        self.forms.append('(%s %s)' % (ref.name, form))
+        self.refs.append(ref)
+        return ref
+
+    def _arg(self, arg):
+        if isinstance(arg, _LispRef):
+            return arg.name
+        self.args.append(arg)
+        return 'a%d' % (len(self.args) - 1)
+
+    def send(self):
+        """Evaluate the calls and return the list of their results"""
+        if not self.forms:
+            return []
+        source = '(let* (%s) (list %s))' % (
+            ' '.join(self.forms),
+            ' '.join(ref.name if ref.result else 'nil' for ref in self.refs))
+        results = lisp.ropemacs__batch(source, self.args)
+        for ref, value in zip(self.refs, results):
+            ref.value = value
+        self.forms = []
+        self.args = []
+        self.refs = []
+        return results
+
+
+class _LispRef(object):
+
+    def __init__(self, name, result=True):
+        self.name = name
+        self.result = result
+        self.value = None
+
+
+class _BulkTransport(object):
+    """Pass large strings between python and emacs through files
+
+    Pymacs quotes and parses every character it transfers; when
+    `ropemacs-bulk-transport-size' is set, strings at least that long
+    are written to a file in a private temporary folder (in /dev/shm
+    when it exists, so they stay in memory) and only its name crosses
+    the pymacs channel.  The reader deletes the file.  This requires
+    emacs and python to run on the same host.
+    """
+
+    def __init__(self):
+        self.size = None
+        self.folder = None
+        self.counter = itertools.count()
+
+    def filename(self):
+        if self.folder is None:
+            shm = '/dev/shm'
+            self.folder = tempfile.mkdtemp(
+                prefix='ropemacs-', dir=shm if os.path.isdir(shm) else None)
+            atexit.register(shutil.rmtree, self.folder, True)
+        return join(self.folder, 'bulk-%d' % next(self.counter))
+
+    def argument(self, batch, text):
+        """Return `text` or a reference to it for `batch` calls"""
+        if self.size is None or text is None or len(text) < self.size:
+            return text
+        filename = self.filename()
+        with open(filename, 'w', encoding='utf-8', newline='') as output:
+            output.write(text)
+        return batch.call('ropemacs--bulk-read', filename, result=False)
+
+    def text(self, text, filename):
+        """Return `text` or, if it is `None`, what emacs wrote to `filename`"""
+        if text is not None:
+            return text
+        with open(filename, encoding='utf-8', newline='') as input:
+            text = input.read()
+        os.remove(filename)
+        return text
+
+_bulk = _BulkTransport()
+
+
+class _BufferShadows(object):
+    """Python-side copies of buffer texts
+
+    The copies are updated using the changes `ropemacs-mode' records
+    in each buffer; the whole text is transferred only when a buffer
+    is seen for the first time or when its changes were not tracked.
+    Copies are keyed by the version `ropemacs--sync-text' assigns to
+    the text it describes.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.texts = collections.OrderedDict()
+
+    def text(self):
+        filename = _bulk.filename() if _bulk.size is not None else None
+        version, base, payload, size = lisp.ropemacs__sync_text(None, filename)
+        text = None
+        if base is not None:
+            text = self._apply(self.texts.pop(base, None), payload, size)
+            if text is None:
+                version, base, payload, size = lisp.ropemacs__sync_text(
+                    True, filename)
+        if text is None:
+            text = _bulk.text(payload, filename)
+        self.texts[version] = text
+        self.shrink(self.size)
+        return text
+
+    def usage(self):
+        """Return the number of characters in the copies"""
+        return sum(len(text) for text in self.texts.values())
+
+    def shrink(self, size):
+        """Drop all but the `size` most recent copies"""
+        while len(self.texts) > size:
+            self.texts.popitem(last=False)
+
+    def _apply(self, text, changes, size):
+        if text is None:
+            return None
+        for start, length, inserted in changes:
+            start -= 1
+            text = text[:start] + inserted + text[start + length:]
+        if len(text) != size:
+            return None
+        return text
+
+_shadows = _BufferShadows()
+
+class _LineIndex(object):
+    """The offsets at which the lines of a text start"""
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = array.array('I', [0])
+        self.starts.extend(itertools.accumulate(
+            len(line) + 1 for line in text.split('\n')))
+        # the last entry is one past the end of the text
+        self.starts[-1] = len(text)
+
+    def line(self, lineno):
+        """Return line number `lineno` including its newline"""
+        if not 0 < lineno < len(self.starts):
+            return ''
+        return self.text[self.starts[lineno - 1]:self.starts[lineno]]
+
+    def lineno(self, offset):
+        return bisect.bisect_right(self.starts, offset, 0,
+                                   len(self.starts) - 1)
+
+    def offset(self, lineno):
+        return self.starts[lineno - 1]
+
+
+class _LineIndexCache(object):
+    """Line indexes of recently used files
+
+    Indexes are invalidated when the modification time or the size of
+    their file changes.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.indexes = collections.OrderedDict()
+
+    def get(self, filename):
+        stat = os.stat(filename)
+        stamp = (stat.st_mtime, stat.st_size)
+        cached = self.indexes.pop(filename, None)
+        if cached is None or cached[0] != stamp:
+            with open(filename) as f:
+                cached = (stamp, _LineIndex(f.read()))
+        self.indexes[filename] = cached
+        while len(self.indexes) > self.size:
+            self.indexes.popitem(last=False)
+        return cached[1]
+
+_line_indexes = _LineIndexCache()
+
+
+class _MemoryGovernor(object):
+    """Keep the analysis state of a project within a memory budget
+
+    Rope keeps every module it analyzes until the project is closed
+    and ropemacs keeps copies of buffer texts; in long sessions they
+    grow without bound.  Their size is estimated from the length of
+    their texts and, when it exceeds `ropemacs-memory-budget'
+    megabytes, buffer copies other than the latest and then the least
+    recently used modules are dropped, once the command that exceeded
+    it is done, until a quarter of the budget is free again.  The
+    modules of files visited in emacs are kept.  Rope analyzes dropped
+    modules again when they are next used.
+    """
+
+    # bytes rope keeps for each character of an analyzed module
+    module_weight = 75
+    low_water = 0.75
+
+    def __init__(self, project, budget):
+        self.project = project
+        self.budget = budget * 1024 * 1024
+        self.modules = collections.OrderedDict()
+        self.total = 0
+        self.evicted = 0
+        self.get_pymodule = None
+
+    def install(self):
+        module_cache = self.project.pycore.module_cache
+        self.get_pymodule = module_cache.get_pymodule
+        module_cache.get_pymodule = self._get_pymodule
+
+    def _get_pymodule(self, resource, force_errors=False):
+        pymodule = self.get_pymodule(resource, force_errors=force_errors)
+        if resource in self.modules:
+            self.modules.move_to_end(resource)
+        elif resource in self.project.pycore.module_cache.module_map:
+            size = len(getattr(pymodule, 'source_code', '')) * \
+                self.module_weight
+            self.modules[resource] = size
+            self.total += size
+        return pymodule
+
+    def trim(self):
+        """Shrink if over the budget; called between commands
+
+        Dropping modules while a command uses them would make it see
+        parts of the project twice or not at all.
+        """
+        if self.total + _shadows.usage() > self.budget:
+            self.shrink(self._visited())
+
+    def _visited(self):
+        """Return the resources of the project files emacs visits"""
+        from rope.base import libutils
+        result = set()
+        for filename in _paths.on_python_host(LispUtils().filenames()):
+            path = libutils.path_relative_to_project_root(self.project,
+                                                          filename)
+            if path is not None:
+                result.add(self.project.get_file(path))
+        return result
+
+    def shrink(self, visited=()):
+        """Drop buffer copies and modules until below the low water mark
+
+        The modules of `visited` resources and the latest one are kept.
+        """
+        module_cache = self.project.pycore.module_cache
+        # modules rope has invalidated itself
+        for resource in [resource for resource in self.modules
+                         if resource not in module_cache.module_map]:
+            self.total -= self.modules.pop(resource)
+        target = self.budget * self.low_water
+        if self.total + _shadows.usage() > target:
+            _shadows.shrink(1)
+        evicted = 0
+        for resource in list(self.modules)[:-1]:
+            if self.total + _shadows.usage() <= target:
+                break
+            if resource in visited:
+                continue
+            self.total -= self.modules.pop(resource)
+            del module_cache.module_map[resource]
+            module_cache.observer.remove_resource(resource)
+            evicted += 1
+        if evicted:
+            # other modules may refer to the dropped ones
+            module_cache.forget_all_data()
+            self.evicted += evicted
+
+    def report(self):
+        result = 'ropemacs keeps %d modules and %d buffer copies, ' \
+                 'about %.1f of %.1f MB; %d modules were dropped' % (
+                     len(self.modules), len(_shadows.texts),
+                     (self.total + _shadows.usage()) / 1048576.0,
+                     self.budget / 1048576.0, self.evicted)
+        resident = _resident_size()
+        if resident is not None:
+            result += '; python uses %.1f MB' % (resident / 1048576.0)
+        return result
+
+
+def _resident_size():
+    """Return the resident set size of this process or `None`"""
+    try:
+        with open('/proc/self/statm') as input:
+            return int(input.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _ProjectResources(object):
+    """Install `_MemoryGovernor` in opened projects
+
+    `memory` is the `_MemoryGovernor` of the project, if any.
+    """
+
+    _project = None
+    memory = None
+
+    @property
+    def project(self):
+        return self._project
+
+    @project.setter
+    def project(self, project):
+        if self._project is not None and project is not self._project:
+            _close_worker_pool()
+        self.memory = None
+        if project is not None:
+            budget = self.env.get('memory_budget')
+            if budget:
+                self.memory = _MemoryGovernor(project, budget)
+                self.memory.install()
+        self._project = project
+
+
+def _worker_pool():
+    """Return the worker processes background jobs use
+
+    Workers are spawned, not forked, and import `ropemacs._workers`,
+    which does not use pymacs.  They are kept for later jobs, since
+    they keep what rope has analyzed, until the project is closed.
+    """
+    global _pool
+    if _pool is None:
+        import concurrent.futures
+        import multiprocessing
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+def _close_worker_pool():
+    global _pool, _autoimport_job
+    _autoimport_job = None
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+_pool = None
+atexit.register(_close_worker_pool)
+
+
+class _BackgroundAutoimport(object):
+    """Generate autoimport cache in background if asked to"""
+
+    @_decorated('global_command')
+    def generate_autoimport_cache(self):
+        global _autoimport_job
+        self._global_index = None
+        if not self.env.get('autoimport_in_background'):
+            return super().generate_autoimport_cache()
+        if not self._check_autoimport():
+            return
+        if _autoimport_job is not None:
+            self.env.message('autoimport cache is being generated')
+            return
+        modules = [modname if isinstance(modname, str) else modname.value()
+                   for modname in self.env.get('autoimport_modules') or []]
+        _autoimport_job = _AutoimportJob(self, modules)
+        lisp.ropemacs__autoimport_start()
+
+
+class _AutoimportJob(object):
+    """Generate autoimport cache in worker processes
+
+    Only project modules that changed since they were last cached are
+    read again; their modification times and sizes are kept in the
+    `ropemacs-autoimport` file of `.ropeproject` folder.  `poll()`
+    reports the progress and merges the names when all are ready.
+    """
+
+    filename = 'ropemacs-autoimport'
+    chunk_size = 64
+
+    def __init__(self, interface, modules):
+        self.interface = interface
+        self.project = interface.project
+        self.autoimport = interface.autoimport
+        self.progress = interface.env.create_progress(
+            'Generating autoimport cache')
+        self.stamps = self._read()
+        changed = []
+        for resource in self.project.get_python_files():
+            stamp = _file_stamp(resource.real_path)
+            modname = self.autoimport._module_name(resource)
+            if self.stamps.get(resource.path) != stamp or \
+               modname not in self.autoimport.names:
+                self.stamps[resource.path] = stamp
+                changed.append(resource.path)
+        underlined = interface.env.get('autoimport_underlineds')
+        executor = _worker_pool()
+        self.futures = []
+        for start in range(0, len(changed), self.chunk_size):
+            self.futures.append(executor.submit(
+                _workers.autoimport_names, self.project.address, underlined,
+                changed[start:start + self.chunk_size], []))
+        for modname in modules:
+            self.futures.append(executor.submit(
+                _workers.autoimport_names, self.project.address, underlined,
+                [], [modname]))
+
+    def poll(self):
+        """Report the progress and return whether the job is done"""
+        done = sum(1 for future in self.futures if future.done())
+        if done < len(self.futures):
+            self.progress.update(100 * done // len(self.futures))
+            return False
+        try:
+            for future in self.futures:
+                self.autoimport.names.update(future.result())
+            self.interface._global_index = None
+            self._write()
+        finally:
+            self.progress.done()
+        return True
+
+    def _read(self):
+        if self.project.ropefolder is None:
+            return {}
+        try:
+            with open(self._path(), 'rb') as input:
+                return pickle.load(input)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def _write(self):
+        if self.project.ropefolder is not None:
+            with open(self._path(), 'wb') as output:
+                pickle.dump(self.stamps, output, pickle.HIGHEST_PROTOCOL)
+
+    def _path(self):
+        return join(self.project.ropefolder.real_path, self.filename)
+
+_autoimport_job = None
+
+
+class _IndexedFindFile(object):
+    """Match files in python for `rope-find-file` if asked to"""
+
+    _file_index = None
+
+    def _base_find_file(self, prefix):
+        if not self.env.get('indexed_find_file') or \
+           not lisp.ropemacs__completion_tables_p():
+            return super()._base_find_file(prefix)
+        self._check_project()
+        result = lisp.ropemacs__read_candidate(
+            'Rope Find File: ', lisp['rope-find-file-candidates'],
+            bool(prefix))
+        if result is None:
+            self.env.message('No file selected')
+            return
+        return self.project.get_file(_FileIndex.path(result))
+
+    def file_index(self):
+        self._check_project()
+        if self._file_index is None or \
+           self._file_index.project is not self.project:
+            self._file_index = _FileIndex(self.project)
+        return self._file_index
+
+
+class _FileIndex(object):
+    """The files of a project, for matching their names fuzzily
+
+    Names are like those `rope-find-file` shows: file name first,
+    then its parent folders, separated with `<`.  The index observes
+    the project and is updated when rope reports files as created,
+    changed, moved or removed; it is built again only when folders
+    change.  Files created outside emacs appear after opening the
+    project again.
+    """
+
+    limit = 100
+
+    def __init__(self, project):
+        self.project = project
+        self.files = None
+        self.last = None
+        from rope.base import resourceobserver
+        project.add_observer(resourceobserver.ResourceObserver(
+            changed=self._created, moved=self._moved,
+            created=self._created, removed=self._removed))
+
+    @staticmethod
+    def name(path):
+        return '<'.join(reversed(path.split('/')))
+
+    @staticmethod
+    def path(name):
+        return '/'.join(reversed(name.split('<')))
+
+    def match(self, pattern, python_only=False):
+        """Return the best `limit` names matching `pattern` fuzzily
+
+        The characters of `pattern` should appear in the name in the
+        same order; names in which they are closer come first.
+        """
+        files = self._get_files()
+        key = (pattern, python_only)
+        if self.last is not None and self.last[0][1] == python_only and \
+           pattern.startswith(self.last[0][0]):
+            names = self.last[1]
+        else:
+            names = [name for name, python in files.values()
+                     if python or not python_only]
+        regex = re.compile('.*?'.join(re.escape(char) for char in pattern),
+                           re.IGNORECASE)
+        scored = []
+        for name in names:
+            found = regex.search(name)
+            if found is not None:
+                scored.append((found.end() - found.start(), found.start(),
+                               len(name), name))
+        self.last = (key, [entry[-1] for entry in scored])
+        return [entry[-1] for entry in heapq.nsmallest(self.limit, scored)]
+
+    def _get_files(self):
+        if self.files is None:
+            self.files = {}
+            for resource in self.project.get_files():
+                self._add(resource)
+        return self.files
+
+    def _add(self, resource):
+        self.files[resource.path] = (
+            self.name(resource.path),
+            self.project.pycore.is_python_file(resource))
+
+    def _created(self, resource):
+        if resource.is_folder():
+            self._invalidate(resource)
+        elif self.files is not None and resource.path not in self.files \
+             and not self.project.is_ignored(resource):
+            self._add(resource)
+            self.last = None
+
+    def _moved(self, resource, new_resource):
+        self._removed(resource)
+        self._created(new_resource)
+
+    def _removed(self, resource):
+        if resource.is_folder():
+            self._invalidate(resource)
+        elif self.files is not None:
+            self.files.pop(resource.path, None)
+            self.last = None
+
+    def _invalidate(self, resource):
+        self.files = None
+        self.last = None
+
+
+class _IndexedGlobals(object):
+    """Look global names up in python for `rope-jump-to-global` if asked to"""
+
+    _global_index = None
+
+    @_decorated('local_command', 'a j')
+    def jump_to_global(self):
+        if not self.env.get('indexed_jump_to_global') or \
+           not lisp.ropemacs__completion_tables_p():
+            return super().jump_to_global()
+        if not self._check_autoimport():
+            return
+        name = lisp.ropemacs__read_candidate(
+            'Global name: ', lisp['rope-global-name-candidates'])
+        if name is None:
+            return
+        result = dict(self.global_index().locations(name))
+        if len(result) == 1:
+            resource = list(result.keys())[0]
+        else:
+            resource = self._ask_file(result.keys())
+        if resource:
+            self._goto_location(resource, result[resource])
+
+    def global_index(self):
+        if not self._check_autoimport():
+            return
+        if self._global_index is None or \
+           self._global_index.autoimport is not self.autoimport:
+            self._global_index = _GlobalIndex(self.project, self.autoimport)
+        return self._global_index
+
+
+class _GlobalIndex(object):
+    """The names in autoimport cache sorted for looking them up
+
+    `names` is the sorted list of names and `modules` maps each to the
+    modules defining it.  Names of a module are updated when rope
+    reports it as changed, after autoimport cache itself is updated.
+    """
+
+    limit = 100
+    # the most characters between those of a pattern in each pass of
+    # `match()`; 0 means any number
+    gaps = (1, 3, 8, 0)
+
+    def __init__(self, project, autoimport):
+        self.project = project
+        self.autoimport = autoimport
+        self.names = None
+        self.modules = None
+        self.defined = None
+        self.lines = None
+        from rope.base import resourceobserver
+        project.add_observer(resourceobserver.ResourceObserver(
+            changed=self._changed, moved=self._moved,
+            removed=self._changed))
+
+    def match(self, pattern):
+        """Return the best `limit` names matching `pattern`
+
+        Names starting with `pattern` come first, shorter ones first;
+        then names containing it and names containing its characters
+        in the same order with more and more characters between them.
+        """
+        self._build()
+        start = bisect.bisect_left(self.names, pattern)
+        result = []
+        for name in itertools.islice(self.names, start, None):
+            if not name.startswith(pattern):
+                break
+            result.append(name)
+        result.sort(key=len)
+        found = set(result)
+        for gap in self.gaps:
+            if len(result) >= self.limit:
+                break
+            between = '[^\n]{0,%d}?' % gap if gap else '[^\n]*?'
+            regex = re.compile(between.join(re.escape(char)
+                                            for char in pattern))
+            scored = []
+            for match in regex.finditer(self._lines().text):
+                lineno = self.lines.lineno(match.start())
+                name = self.names[lineno - 1]
+                if name not in found:
+                    found.add(name)
+                    scored.append((match.end() - match.start(),
+                                   match.start() - self.lines.offset(lineno),
+                                   len(name), name))
+                    if len(result) + len(scored) >= self.limit:
+                        break
+            result.extend(entry[-1] for entry in sorted(scored))
+        return result[:self.limit]
+
+    def locations(self, name):
+        """Return a list of ``(resource, lineno)`` tuples"""
+        from rope.base import exceptions
+        self._build()
+        result = []
+        for modname in self.modules.get(name, ()):
+            try:
+                pymodule = self.project.get_module(modname)
+            except exceptions.ModuleNotFoundError:
+                continue
+            if name in pymodule:
+                module, lineno = pymodule[name].get_definition_location()
+                if module is not None:
+                    resource = module.get_module().get_resource()
+                    if resource is not None and lineno is not None:
+                        result.append((resource, lineno))
+        return result
+
+    def _build(self):
+        if self.names is not None:
+            return
+        self.modules = {}
+        self.defined = {}
+        for modname, names in self.autoimport.names.items():
+            self.defined[modname] = set(names)
+            for name in names:
+                self.modules.setdefault(name, []).append(modname)
+        self.names = sorted(self.modules)
+
+    def _lines(self):
+        if self.lines is None:
+            self.lines = _LineIndex('\n'.join(self.names))
+        return self.lines
+
+    def _changed(self, resource):
+        self.lines = None
+        if self.names is None or resource.is_folder():
+            self.names = None
+            return
+        modname = self.autoimport._module_name(resource)
+        old = self.defined.pop(modname, set())
+        new = set(self.autoimport.names.get(modname, ()))
+        if new:
+            self.defined[modname] = new
+        for name in old - new:
+            self.modules[name].remove(modname)
+            if not self.modules[name]:
+                del self.modules[name]
+                del self.names[bisect.bisect_left(self.names, name)]
+        for name in new - old:
+            if name not in self.modules:
+                bisect.insort(self.names, name)
+            self.modules.setdefault(name, []).append(modname)
+
+    def _moved(self, resource, new_resource):
+        self._changed(resource)
+        self._changed(new_resource)
+
+
+class _PatchedReload(object):
+    """Pass the new text of changed files to `LispUtils.reload_files`"""
+
+    def _reload_buffers(self, changes, undo=False):
+        moved = self._get_moved_resources(changes, undo)
+        contents = _changed_contents(changes, undo)
+        self.env.reload_files(
+            [resource.real_path for resource in changes.get_changed_resources()],
+            dict((resource.real_path, moved[resource].real_path)
+                 for resource in moved),
+            dict((resource.real_path, contents[resource])
+                 for resource in contents))
+
+
+class _ParallelOccurrences(object):
+    """Search occurrences in worker processes if asked to"""
+
+    @_decorated('local_command', 'a f', shortcut='C-c f')
+    def find_occurrences(self):
+        if not self.env.get('parallel_find_occurrences'):
+            return super().find_occurrences()
+        from ropemode import dialog, refactor
+        optionals = {
+            'unsure': dialog.Data('Find uncertain occurrences: ',
+                                  default='no', values=['yes', 'no']),
+            'resources': dialog.Data('Files to search: '),
+            'in_hierarchy': dialog.Data(
+                    'Rename methods in class hierarchy: ',
+                    default='no', values=['yes', 'no'])}
+        self._check_project()
+        self._save_buffers()
+        resource, offset = self._get_location()
+        action, values = dialog.show_dialog(
+            self._askdata, ['search', 'cancel'], optionals=optionals)
+        if action != 'search':
+            return
+        resources = refactor._resources(self.project, values.get('resources'))
+        search = _OccurrencesSearch(
+            self.project, resource, offset, resources,
+            values.get('unsure') == 'yes',
+            values.get('in_hierarchy') == 'yes')
+        search.run(self.env)
+
+
+class _OccurrencesSearch(object):
+    """Find occurrences in worker processes
+
+    Only the modules whose text contains the name as a word are
+    searched.  They are split in chunks, a few for each worker, and
+    the occurrences found in a chunk are shown as soon as it and the
+    chunks before it are done.  While waiting, emacs redisplays and
+    C-g cancels the search; see `ropemacs--wait'.
+    """
+
+    chunks_per_worker = 4
+    wait = 0.05
+    searches = itertools.count()
+
+    def __init__(self, project, resource, offset, resources, unsure,
+                 in_hierarchy):
+        from rope.base import worder
+        name = worder.get_name_at(resource, offset)
+        if resources is None:
+            resources = project.get_python_files()
+        word = re.compile(rb'\b%s\b' % re.escape(name.encode('utf-8')))
+        paths = [resource.path for resource in resources
+                 if self._contains(resource, word)]
+        workers = os.cpu_count() or 1
+        size = max(1, -(-len(paths) // (workers * self.chunks_per_worker)))
+        search = next(self.searches)
+        executor = _worker_pool()
+        self.futures = [executor.submit(
+            _workers.occurrences_in, project.address, search, resource.path,
+            offset, unsure, in_hierarchy, paths[start:start + size])
+                        for start in range(0, len(paths), size)]
+        self.root = project.address
+
+    def _contains(self, resource, word):
+        try:
+            with open(resource.real_path, 'rb') as input:
+                return word.search(input.read()) is not None
+        except OSError:
+            return False
+
+    def run(self, env):
+        """Show the occurrences as they are found"""
+        progress = env.create_progress('Find Occurrences')
+        writer = env._occurrences_writer()
+        writer.flush()
+        shown = 0
+        try:
+            while shown < len(self.futures):
+                if not self.futures[shown].done():
+                    if lisp.ropemacs__wait(self.wait):
+                        env.message('Find Occurrences cancelled')
+                        return
+                    continue
+                env._write_occurrences(writer, [
+                    _FoundLocation(join(self.root, path), offset, lineno,
+                                   '?' if unsure else '')
+                    for path, offset, unsure, lineno
+                    in self.futures[shown].result()])
+                writer.flush()
+                shown += 1
+                progress.update(100 * shown // len(self.futures))
+        finally:
+            for future in self.futures:
+                future.cancel()
+            progress.done()
+
+
+class _FoundLocation(object):
+    """An occurrence `_OccurrencesSearch` found, like `ropemode` locations"""
+
+    def __init__(self, filename, offset, lineno, note):
+        self.filename = filename
+        self.offset = offset
+        self.lineno = lineno
+        self.note = note
+
+
+class _BackgroundAnalysis(object):
+    """Analyze saved modules in a worker thread if asked to"""
+
+    _analysis = None
+
+    @_decorated('rope_hook', 'after_save')
+    def after_save_actions(self):
+        if not self.env.get('analyze_in_background'):
+            return super().after_save_actions()
+        if self.project is not None and self.old_content is not None:
+            from rope.base import libutils
+            resource = libutils.path_to_resource(self.project,
+                                                 self.env.filename())
+            if resource is not None:
+                for observer in list(self.project.observers):
+                    observer.resource_changed(resource)
+                if self.project.pycore.automatic_soa:
+                    self.analysis_queue().add(self.project, resource,
+                                              self.old_content)
+            self.old_content = None
+
+    @_decorated('local_command')
+    def analyze_module(self):
+        """Perform static object analysis on this module"""
+        if not self.env.get('analyze_in_background'):
+            return super().analyze_module()
+        self._check_project()
+        self.analysis_queue().add(self.project, self.resource)
+
+    def analysis_queue(self):
+        if self._analysis is None:
+            self._analysis = _AnalysisQueue(self)
+        return self._analysis
+
+
+class _AnalysisQueue(object):
+    """Perform static object analysis in a worker thread
+
+    Modules are analyzed `delay` seconds after they were last added;
+    adding a module again before that postpones it and, for saves,
+    the analysis covers the scopes changed since the text before the
+    first save.  Among the modules due, the one `current` names is
+    analyzed first.  The worker holds `_rope_lock` while analyzing a
+    module and never calls lisp; emacs polls `status()` instead.
+    """
+
+    delay = 1.0
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.current = None
+        self.running = None
+        self.error = None
+        self.thread = None
+
+    def add(self, project, resource, old_content=None):
+        """Queue `resource`; without `old_content` analyze it all"""
+        with self.condition:
+            entry = self.pending.pop(resource.path, None)
+            if entry is not None and entry[2] is not None and \
+               old_content is not None:
+                old_content = entry[2]
+            self.pending[resource.path] = (time.time() + self.delay,
+                                           project, old_content, resource)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work,
+                                               name='ropemacs-analysis')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        lisp.ropemacs__analysis_start()
+
+    def status(self, current):
+        """Return what the mode line should show or `None` when idle
+
+        `current` is the file of the current buffer, as emacs names it.
+        """
+        path = None
+        project = self.interface.project
+        if current and project is not None:
+            from rope.base import libutils
+            path = libutils.path_relative_to_project_root(
+                project, self.interface.env.path_on_python_host(current))
+        with self.condition:
+            self.current = path
+            if not self.pending and self.running is None:
+                return None
+            count = len(self.pending) + (self.running is not None)
+            return ':%d' % count
+
+    def _work(self):
+        from rope.base import exceptions
+        while True:
+            with self.condition:
+                path = self._next()
+                due, project, old_content, resource = self.pending.pop(path)
+                self.running = path
+            try:
+                with _rope_lock:
+                    if project is self.interface.project:
+                        self._analyze(project, resource, old_content)
+            except exceptions.RopeError:
+                pass
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.condition:
+                    self.running = None
+
+    def _next(self):
+        while True:
+            now = time.time()
+            due = [path for path, entry in self.pending.items()
+                   if entry[0] <= now]
+            if due:
+                return self.current if self.current in due else due[0]
+            timeout = None
+            if self.pending:
+                timeout = min(entry[0] for entry in self.pending.values()) - now
+            self.condition.wait(timeout)
+
+    def _analyze(self, project, resource, old_content):
+        if not resource.exists():
+            return
+        if old_content is None:
+            project.pycore.analyze_module(resource)
+        else:
+            import rope.base.pycore
+            rope.base.pycore.perform_soa_on_changed_scopes(
+                project, resource, old_content)
+
+
+class _ScopedAnalysis(object):
+    """Give rope only the parts of very large buffers around point
+
+    When the buffer has at least `ropemacs-scoped-analysis-lines'
+    lines, code assists, calltips and docs are computed with the
+    top-level statement around point and the top-level imports; see
+    `_scoped_source()`.  Finding definitions still uses all of the
+    module, since they may be anywhere in it.
+    """
+
+    _unscoped = False
+
+    def _get_text(self):
+        lines = self.env.get('scoped_analysis_lines')
+        if lines and not self._unscoped:
+            segments = lisp.ropemacs__scoped_text(lines)
+            if segments is not None:
+                return _scoped_source(segments)
+        return super()._get_text()
+
+    def _base_definition_location(self):
+        self._unscoped = True
+        try:
+            return super()._base_definition_location()
+        finally:
+            self._unscoped = False
+
+
+def _scoped_source(segments):
+    """Return a text with only `segments` of a module
+
+    `segments` are (START LINE TEXT) lists, like those
+    `ropemacs--scoped-text' returns.  Each text is put at its offset
+    and line and the rest is blank, so offsets and line numbers in
+    the result are those of the module and need no mapping.
+    """
+    parts = []
+    offset = 0
+    lineno = 1
+    for start, line, text in sorted(segments):
+        start -= 1
+        if start < offset:
+            # overlaps the previous segment; keep only what follows it
+            if start + len(text) <= offset:
+                continue
+            skipped, text = text[:offset - start], text[offset - start:]
+            start = offset
+            line += skipped.count('\n')
+        newlines = line - lineno
+        # a line of spaces is blank for python
+        parts.append(' ' * (start - offset - newlines) + '\n' * newlines)
+        parts.append(text)
+        offset = start + len(text)
+        lineno = line + text.count('\n')
+    return ''.join(parts)
+
+
+def _changed_contents(changes, undo=False):
+    """Map the resources `changes` modify to their text afterwards"""
+    import rope.base.change
+    result = {}
+    if isinstance(changes, rope.base.change.ChangeSet):
+        children = changes.changes
+        for change in reversed(children) if undo else children:
+            result.update(_changed_contents(change, undo))
+    elif isinstance(changes, rope.base.change.ChangeContents):
+        text = changes.old_contents if undo else changes.new_contents
+        if text is not None:
+            result[changes.resource] = text
+    return result
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class _OccurrencesWriter(object):
+    """Insert the lines of an occurrences buffer in chunks
+
+    Each chunk is inserted with a single lisp call and displayed
+    before the next one is prepared.  The file and offset of an
+    occurrence are kept in the text properties of its line, so
+    `ropemacs--occurrences-goto' needs no help from python.
+    """
+
+    chunk_size = 500
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.lines = []
+        self.buttons = []
+        self.files = {}
+        self.locations = []
+        self.length = 0
+
+    def write(self, line, button_length=0, location=None):
+        """Add `line`; its first `button_length` characters make a button
+
+        `location` is the (FILENAME OFFSET) `line` refers to, if any;
+        FILENAME should be a path on lisp host.
+        """
+        if button_length:
+            self.buttons.extend([self.length, self.length + button_length])
+        if location is not None:
+            filename, offset = location
+            index = self.files.setdefault(filename, len(self.files))
+            self.locations.extend([self.length, self.length + len(line),
+                                   index, offset])
+        self.lines.append(line)
+        self.length += len(line)
+        if len(self.lines) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            batch = _LispBatch()
+            text = _bulk.argument(batch, ''.join(self.lines))
+            batch.call('ropemacs--insert-occurrences', self.buffer, text,
+                       self.buttons, sorted(self.files, key=self.files.get),
+                       self.locations)
+            batch.send()
+        self.lines = []
+        self.buttons = []
+        self.files = {}
+        self.locations = []
+        self.length = 0
+
+class _DiffSections(object):
+    """The changes of each file in a large preview
+
+    The preview lists the changed files first; the diff of a file is
+    sent to emacs when its line is toggled.  A diff starts at its
+    `---` line, or a `diff` line before it, and ends at the first
+    line that is not part of a hunk; other lines of the description,
+    like those describing moved files, stay in the list.  Sections
+    are kept as offsets into the description of the changes.
+    """
+
+    _section = re.compile(
+        r'^(?:diff .*\n)?--- a/(.*)\n\+\+\+ b/.*(?:\n|\Z)', re.MULTILINE)
+    _hunks = re.compile(
+        r'(?:(?!--- a/.*\n\+\+\+ b/)[-+ @\\].*(?:\n|\Z))*')
+
+    def __init__(self, diffs):
+        self.diffs = diffs
+        self.paths = []
+        self.spans = []
+        # the texts between diffs and the indexes of diffs, in order
+        self.items = []
+        self.head = len(diffs)
+        end = None
+        for match in self._section.finditer(diffs):
+            if end is None:
+                self.head = match.start()
+            else:
+                self._add_text(end, match.start())
+            end = self._hunks.match(diffs, match.end()).end()
+            self.items.append(len(self.paths))
+            self.paths.append(match.group(1))
+            self.spans.append((match.start(), match.end(), end))
+        if end is not None:
+            self._add_text(end, len(diffs))
+
+    def _add_text(self, start, end):
+        if self.diffs[start:end].strip():
+            self.items.append(self.diffs[start:end])
+
+    def header(self):
+        return self.diffs[:self.head]
+
+    def summary(self):
+        """Return a list of (LABEL INDEX) for each changed file
+
+        The texts between diffs are included as (TEXT nil).
+        """
+        result = []
+        for item in self.items:
+            if not isinstance(item, int):
+                result.append([item, None])
+                continue
+            start, hunks, end = self.spans[item]
+            lines = '\n' + self.diffs[hunks:end]
+            result.append(['%s  +%d -%d' % (self.paths[item],
+                                            lines.count('\n+'),
+                                            lines.count('\n-')), item])
+        return result
+
+    def section(self, index):
+        start, hunks, end = self.spans[index]
+        return self.diffs[start:end]
+
+_preview = None
+
+
 class _LispProgress(object):
 
     def __init__(self, name):
@@ -410,43 +2105,156 @@ class _OldProgress(object):
 def message(message):
     lisp.message(message.replace('%', '%%'))
 
+def completion_candidates(key, prefix):
+    """Return the completions that start with `prefix'
+
+    `key' identifies the text around `prefix'; see
+    `ropemacs--completion-key'.  Completions are reused while the
+    text around `prefix' does not change and `prefix' is extended.
+    """
+    key = tuple(key)
+    completions = _completion_cache.get(key, prefix)
+    if completions is None:
+        env = LispUtils()
+        with _rope_lock:
+            import ropemode.interface
+            from rope.base import exceptions
+            try:
+                proposals = ropemode.interface._CodeAssist(
+                    _interface, env)._calculate_proposals()
+            except exceptions.RopeError:
+                return []
+        result = _Completions(prefix, proposals, env)
+        _completion_cache.put(key, result)
+        completions = result.filter(prefix)
+    return completions
+
+def completion_doc(candidate):
+    """Return (FOUND DOC) for a candidate of the last completions
+
+    FOUND is nil if `candidate' was not among the completions last
+    returned by `rope-completion-candidates'.
+    """
+    return _resolve_completion(candidate, _Completions.doc)
+
+def completion_location(candidate):
+    """Return (FOUND (FILENAME LINENO)) for a candidate of the last completions
+
+    See `rope-completion-doc'.
+    """
+    return _resolve_completion(candidate, _Completions.location)
+
+def _resolve_completion(candidate, resolve):
+    completions = _completion_cache.last
+    if completions is None or candidate not in completions.proposals:
+        return [False, None]
+    from rope.base import exceptions
+    with _rope_lock:
+        try:
+            return [True, resolve(completions, candidate)]
+        except exceptions.RopeError:
+            return [True, None]
+
+def completions_start(key, prefix):
+    """Start computing `rope-completion-candidates' in background
+
+    Returns the id of the job to pass to `rope-completions-poll'.
+    """
+    return _async_completions.start(LispUtils(), tuple(key), prefix)
+
+def completions_poll(id):
+    """Return (DONE COMPLETIONS) for the job started with `rope-completions-start'
+
+    Return nil for jobs replaced by a newer one.
+    """
+    return _async_completions.poll(id)
+
+def find_file_candidates(pattern, python_only):
+    """Return the project files best matching `pattern'
+
+    See `ropemacs-indexed-find-file'.
+    """
+    with _rope_lock:
+        return _interface.file_index().match(pattern, bool(python_only))
+
+def global_name_candidates(pattern):
+    """Return the global names best matching `pattern'
+
+    See `ropemacs-indexed-jump-to-global'.
+    """
+    with _rope_lock:
+        index = _interface.global_index()
+        return index.match(pattern) if index is not None else []
+
+def preview_section(index):
+    """Return the changes of a file in `*rope-preview*'"""
+    if _preview is None:
+        return ''
+    return _preview.section(index)
+
+def autoimport_poll():
+    """Report the progress of generating autoimport cache in background
+
+    Return non-nil when there is nothing left to wait for.
+    """
+    global _autoimport_job
+    if _autoimport_job is None:
+        return True
+    try:
+        with _rope_lock:
+            if not _autoimport_job.poll():
+                return False
+    except Exception as e:
+        import ropemode.decorators
+        ropemode.decorators.logger(traceback.format_exc(),
+                                   'Generating autoimport cache failed: %s' % e)
+    _autoimport_job = None
+    return True
+
+def analysis_poll(filename):
+    """Return what the mode line shows for background analysis
+
+    `filename' is the file of the current buffer; it is analyzed
+    first.  Return nil when there is nothing left to analyze.
+    """
+    queue = _interface._analysis if _interface is not None else None
+    if queue is None:
+        return None
+    if queue.error is not None:
+        error, queue.error = queue.error, None
+        message('Background analysis failed: %s' % error)
+    return queue.status(filename)
+
+def show_stats(prefix):
+    """Show the time ropemacs commands have taken
+
+    Statistics are collected only if `ropemacs-profile-commands' is
+    non-nil when ropemacs is loaded.  With prefix, clear them.
+    """
+    if _profiler is None:
+        message('ropemacs-profile-commands was nil when loading ropemacs')
+        return
+    LispUtils()._make_buffer('*rope-stats*', _profiler.report(), switch=True)
+    if prefix:
+        _profiler.samples.clear()
+show_stats.interaction = 'P'
+
+def show_memory():
+    """Show how much of `ropemacs-memory-budget' is used"""
+    with _rope_lock:
+        memory = _interface.memory if _interface is not None else None
+        if memory is None:
+            message('ropemacs-memory-budget is nil or no project is open')
+            return
+        message(memory.report())
+show_memory.interaction = ''
+
 def occurrences_goto():
-    if lisp.line_number_at_pos() < 1:
-        lisp.forward_line(1 - lisp.line_number_at_pos())
-    lisp.end_of_line()
-    end = lisp.point()
-    lisp.beginning_of_line()
-    line = lisp.buffer_substring_no_properties(lisp.point(), end)
-    tokens = line.split()
-    semicolon_tokens = line.split(":")
-
-    project_root = lisp.rope_get_project_root()
-    if tokens and semicolon_tokens:
-        # Mark this line with an arrow
-        lisp('''
-        (remove-overlays (point-min) (point-max))
-            (overlay-put (make-overlay (line-beginning-position) (line-end-position))
-            'before-string
-            (propertize "A" 'display '(left-fringe right-triangle)))
-        ''')
-
-
-        filename = project_root + "/" + semicolon_tokens[0]
-        offset = int(tokens[-1])
-        resource = _interface._get_resource(filename)
-        LispUtils().find_file(resource.real_path, other=True)
-        lisp.goto_char(offset + 1)
+    lisp.ropemacs__occurrences_goto()
 occurrences_goto.interaction = ''
 
 def occurrences_next(arg, reset):
-    lisp.switch_to_buffer_other_window('*rope-occurrences*', True)
-    if reset:
-        lisp.goto_char(lisp.point_min())
-    lisp.forward_line(arg)
-    if lisp.eobp():
-        lisp.message("Cycling rope occurrences")
-        lisp.goto_char(lisp.point_min())
-    occurrences_goto()
+    lisp.ropemacs__occurrences_next(arg, reset)
 occurrences_next.interaction = ''
 
 
@@ -463,6 +2271,13 @@ If non-nil, you have to confirm saving all modified
 python files before refactorings; otherwise they are
 saved automatically.")
 
+(defcustom ropemacs-confirm-saving-at-once 'nil
+  "Confirm saving all modified buffers with one question.
+
+If non-nil and `ropemacs-confirm-saving' is non-nil, the modified
+python buffers are listed in a single question before refactorings
+and either all or none of them are saved.")
+
 (defcustom ropemacs-codeassist-maxfixes 1
   "The number of errors to fix before code-assist.
 
@@ -478,8 +2293,108 @@ How many errors to fix, at most, when proposing code completions.")
 
 This affect all ropemacs function including `rope-show-doc'.")
 
+(defcustom ropemacs-sync-buffer-changes 'nil
+  "Send only the changed parts of buffers to rope.
+
+If non-nil, `ropemacs-mode' records the modifications made to a
+buffer and ropemacs keeps a copy of its text; commands then
+transfer the changes made since their last use instead of the
+whole buffer.")
+
+(defcustom ropemacs-bulk-transport-size 'nil
+  "Pass strings at least this long through temporary files.
+
+If non-nil, it should be a number of characters; large buffer texts
+and the contents of ropemacs buffers are written to files and only
+their names are sent through pymacs.  This requires emacs and
+python to run on the same host.  Read when ropemacs is loaded.")
+
+(defcustom ropemacs-async-completions 'nil
+  "Compute completions for `completion-at-point' in background.
+
+If non-nil, emacs stays responsive while rope computes completions;
+they are dropped if input arrives, point moves or the buffer is
+changed before they are ready.")
+
+(defcustom ropemacs-profile-commands 'nil
+  "Record the time ropemacs commands take.
+
+If non-nil when ropemacs is loaded, the total time, the time spent
+waiting for emacs and the number of calls to emacs are recorded for
+each command; use `rope-show-stats' to see them.")
+
+(defcustom ropemacs-indexed-find-file 'nil
+  "Match file names for `rope-find-file' in rope.
+
+If non-nil, rope keeps a list of project files and ranks the ones
+matching the input fuzzily; only the best ones are sent to emacs.
+Not used when `ropemacs-completing-read-function' is
+`ido-completing-read', which needs all the names.")
+
+(defcustom ropemacs-indexed-jump-to-global 'nil
+  "Look global names up in rope for `rope-jump-to-global'.
+
+If non-nil, rope keeps the names in autoimport cache sorted and
+finds the ones matching the input as it is typed; only the best ones
+are sent to emacs.  Not used when `ropemacs-completing-read-function'
+is `ido-completing-read', which needs all the names.")
+
+(defcustom ropemacs-lazy-preview-size 100000
+  "Preview changes at least this long as a list of files.
+
+If non-nil, it should be a number of characters; when the description
+of the changes of a refactoring is that long, `*rope-preview*' lists
+the changed files and the changes of a file are shown when its line
+is toggled.")
+
+(defcustom ropemacs-memory-budget 'nil
+  "The approximate number of megabytes ropemacs may keep analyses in.
+
+If non-nil, the least recently used modules rope has analyzed and
+the copies of buffer texts ropemacs keeps are dropped after commands
+when their estimated size exceeds this; the modules of visited files
+are kept.  `rope-show-memory' shows their size.  Read when a project
+is opened.")
+
+(defcustom ropemacs-parallel-find-occurrences 'nil
+  "Search occurrences in parallel processes.
+
+If non-nil, `rope-find-occurrences' searches only the modules that
+contain the name, in parallel processes; occurrences are shown as
+they are found and C-g cancels the search.")
+
+(defcustom ropemacs-analyze-in-background 'nil
+  "Perform static object analysis in a background thread.
+
+If non-nil, saving a module and `rope-analyze-module' only queue the
+module; it is analyzed a second after it was last saved, the module
+of the current buffer first.  The mode line shows the number of
+modules waiting.")
+
+(defcustom ropemacs-scoped-analysis-lines 'nil
+  "Analyze only the code around point in buffers this long.
+
+If non-nil, it should be a number of lines; in buffers with at least
+that many lines, code assists, calltips and docs are computed with
+only the top-level imports and the top-level definition around
+point.  Names defined elsewhere in the module are not seen then.")
+
+(defcustom ropemacs-lazy-load 'nil
+  "Load rope when it is first needed.
+
+If non-nil, loading ropemacs only defines its variables, keymaps
+and `ropemacs-mode'; rope is imported and ropemacs commands are
+defined when `ropemacs-mode' is first enabled or a key under
+`ropemacs-global-prefix' is first used.")
+
 (defcustom ropemacs-enable-autoimport 'nil
   "Specifies whether autoimport should be enabled.")
+(defcustom ropemacs-autoimport-in-background 'nil
+  "Generate autoimport cache in background processes.
+
+If non-nil, `rope-generate-autoimport-cache' reads modules in
+parallel processes and emacs stays responsive meanwhile; only the
+project modules changed since the last time are read again.")
 (defcustom ropemacs-autoimport-modules nil
   "The name of modules whose global names should be cached.
 
@@ -602,11 +2517,473 @@ already opened.")
 MINOR_MODE = """\
 (require 'thingatpt)
 
+(defun ropemacs--ensure-loaded ()
+  "Define ropemacs commands if `ropemacs-lazy-load' deferred them."
+  (unless (fboundp 'rope-open-project)
+    (rope-load-interface)))
+
+(defun ropemacs--define-commands (commands)
+  "Define the ropemacs COMMANDS `rope-load-interface' has made.
+
+Each of COMMANDS is a (NAME FUNCTION INTERACTIVE DOC) list; the
+command NAME calls the python FUNCTION with `rope-call-command'."
+  (dolist (command commands)
+    (defalias (intern (nth 0 command))
+      `(lambda (&rest arguments)
+         ,(or (nth 3 command) "")
+         ,@(when (nth 2 command)
+             `((interactive ,(nth 2 command))))
+         (apply 'rope-call-command ,(nth 1 command) arguments)))))
+
+(defun ropemacs--load-from-global-prefix ()
+  "Define ropemacs commands and reread the keys that invoked this.
+
+Bound to `ropemacs-global-prefix' until ropemacs commands are
+defined; the commands bind their own keys under it."
+  (interactive)
+  (global-unset-key (this-command-keys))
+  (ropemacs--ensure-loaded)
+  (setq unread-command-events
+        (append (listify-key-sequence (this-command-keys))
+                unread-command-events)))
+
+(defvar ropemacs--analysis-status nil
+  "What the mode line shows for background analysis.")
+
+(defvar ropemacs--analysis-timer nil)
+
+(defun ropemacs--analysis-start ()
+  "Show the state of background analysis until it is done."
+  (unless ropemacs--analysis-timer
+    (setq ropemacs--analysis-timer
+          (run-with-timer 0.5 0.5 'ropemacs--analysis-poll))))
+
+(defun ropemacs--analysis-poll ()
+  (setq ropemacs--analysis-status (rope-analysis-poll (buffer-file-name)))
+  (unless ropemacs--analysis-status
+    (cancel-timer ropemacs--analysis-timer)
+    (setq ropemacs--analysis-timer nil))
+  (force-mode-line-update t))
+
 (define-minor-mode ropemacs-mode
- "ropemacs, rope in emacs!" nil " Rope" ropemacs-local-keymap
+ "ropemacs, rope in emacs!" nil (" Rope" ropemacs--analysis-status)
+ ropemacs-local-keymap
   (if ropemacs-mode
-      (add-hook 'completion-at-point-functions 'ropemacs-completion-at-point nil t)
-    (remove-hook 'completion-at-point-functions 'ropemacs-completion-at-point t)))
+      (progn
+        (ropemacs--ensure-loaded)
+        (add-hook 'completion-at-point-functions 'ropemacs-completion-at-point nil t)
+        (when ropemacs-sync-buffer-changes
+          (add-hook 'before-change-functions 'ropemacs--before-change nil t)
+          (add-hook 'after-change-functions 'ropemacs--after-change nil t)))
+    (remove-hook 'completion-at-point-functions 'ropemacs-completion-at-point t)
+    (remove-hook 'before-change-functions 'ropemacs--before-change t)
+    (remove-hook 'after-change-functions 'ropemacs--after-change t)))
+
+(defun ropemacs--batch (source args)
+  "Evaluate the form read from SOURCE with a0, a1, ... bound to ARGS.
+
+Used by ropemacs to perform a sequence of calls in one round trip."
+  (let ((index -1))
+    (eval `(let ,(mapcar (lambda (arg)
+                           (setq index (1+ index))
+                           (list (intern (format "a%d" index))
+                                 (list 'quote arg)))
+                         args)
+             ,(car (read-from-string source))))))
+
+(defun ropemacs--insert-occurrences (buffer text buttons
+                                            &optional files locations)
+  "Append TEXT to the occurrences BUFFER and redisplay it.
+
+BUTTONS is a flat list of start and end offsets in TEXT of the file
+names that should be shown as buttons.  LOCATIONS is a flat list of
+start and end offsets in TEXT of the lines of occurrences followed
+by the index of their file in FILES and their offset in that file;
+see `ropemacs--occurrences-goto'."
+  (with-current-buffer buffer
+    (let ((inhibit-read-only t)
+          (start (point-max))
+          (files (vconcat files)))
+      (goto-char start)
+      (insert text)
+      (while buttons
+        (add-text-properties
+         (+ start (pop buttons)) (+ start (pop buttons))
+         '(face button mouse-face highlight
+           help-echo "mouse-2: visit this file in other window")))
+      (while locations
+        (put-text-property
+         (+ start (pop locations)) (+ start (pop locations))
+         'ropemacs-occurrence
+         (cons (aref files (pop locations)) (pop locations))))))
+  (redisplay))
+
+(defvar ropemacs--occurrence-overlay nil
+  "The overlay marking the occurrence last visited.")
+
+(defun ropemacs--occurrences-goto ()
+  "Visit the occurrence on the current line of `*rope-occurrences*'."
+  (interactive)
+  (let ((location (get-text-property (line-beginning-position)
+                                     'ropemacs-occurrence)))
+    (when location
+      (if (overlayp ropemacs--occurrence-overlay)
+          (move-overlay ropemacs--occurrence-overlay
+                        (line-beginning-position) (line-end-position)
+                        (current-buffer))
+        (setq ropemacs--occurrence-overlay
+              (make-overlay (line-beginning-position) (line-end-position)))
+        (overlay-put ropemacs--occurrence-overlay 'before-string
+                     (propertize "A" 'display '(left-fringe right-triangle))))
+      (find-file-other-window (car location))
+      (goto-char (1+ (cdr location))))))
+
+(defun ropemacs--occurrences-next (arg reset)
+  "Visit the ARGth next occurrence; the `next-error-function' of occurrences."
+  (interactive "p\nP")
+  (switch-to-buffer-other-window "*rope-occurrences*" t)
+  (when reset
+    (goto-char (point-min)))
+  (forward-line arg)
+  (when (eobp)
+    (message "Cycling rope occurrences")
+    (goto-char (or (next-single-property-change (point-min)
+                                                'ropemacs-occurrence)
+                   (point-min))))
+  (ropemacs--occurrences-goto))
+
+(defun ropemacs--load-key-bindings (name)
+  "Load the key bindings ropemacs saved in NAME; return nil if missing."
+  (load (locate-user-emacs-file name) t t))
+
+(defun ropemacs--save-key-bindings (name source)
+  "Evaluate the key bindings in SOURCE and save them in NAME.
+
+The file is byte-compiled for `ropemacs--load-key-bindings'.  The
+files saved for older versions of NAME, which differ only in the
+digest that ends it, are deleted."
+  (eval (car (read-from-string (concat "(progn " source ")"))))
+  (let* ((file (locate-user-emacs-file (concat name ".el")))
+         (prefix (substring name 0 (1+ (string-match "-[^-]*\\\\'" name))))
+         (old (concat "\\\\`" (regexp-quote prefix)
+                      "[0-9a-f]+\\\\.elc?\\\\'")))
+    (condition-case nil
+        (progn
+          (with-temp-file file
+            (insert "(defvar ropemacs-local-keymap)\n" source "\n"))
+          (byte-compile-file file)
+          (dolist (other (directory-files (file-name-directory file) t old))
+            (unless (equal (file-name-sans-extension
+                            (file-name-nondirectory other))
+                           name)
+              (delete-file other))))
+      (error nil))))
+
+(defun ropemacs--save-buffers (files)
+  "Save the modified buffers visiting FILES.
+
+See `ropemacs-confirm-saving' and `ropemacs-confirm-saving-at-once'."
+  (let (buffers)
+    (dolist (file files)
+      (let ((buffer (find-buffer-visiting file)))
+        (when (and buffer (buffer-modified-p buffer))
+          (push buffer buffers))))
+    (setq buffers (nreverse buffers))
+    (when (and buffers ropemacs-confirm-saving ropemacs-confirm-saving-at-once)
+      (unless (y-or-n-p (format "Save %d modified buffers (%s)? "
+                                (length buffers)
+                                (mapconcat 'buffer-name buffers ", ")))
+        (setq buffers nil)))
+    (dolist (buffer buffers)
+      (when (or (not ropemacs-confirm-saving)
+                ropemacs-confirm-saving-at-once
+                (y-or-n-p (format "Save %s buffer?" (buffer-file-name buffer))))
+        (with-current-buffer buffer
+          (save-buffer))))))
+
+(defvar ropemacs-preview-section-map
+  (let ((map (make-sparse-keymap)))
+    (define-key map (kbd "TAB") 'ropemacs-preview-toggle-section)
+    (define-key map (kbd "RET") 'ropemacs-preview-toggle-section)
+    (define-key map [mouse-2] 'ropemacs-preview-toggle-section)
+    map)
+  "Keymap for the file lines of large `*rope-preview*' buffers.")
+
+(defun ropemacs--preview-sections (header sections)
+  "Show HEADER and a line for each of SECTIONS in `*rope-preview*'.
+
+Each of SECTIONS is (LABEL INDEX); the changes of a file are asked
+from rope when its line is toggled.  Sections with a nil INDEX are
+texts shown as they are."
+  (let ((buffer (get-buffer-create "*rope-preview*")))
+    (with-current-buffer buffer
+      (let ((inhibit-read-only t))
+        (erase-buffer)
+        (insert header)
+        (dolist (section sections)
+          (if (null (cadr section))
+              (insert (car section))
+            (insert (propertize (car section)
+                                'ropemacs-section (cadr section)
+                                'keymap ropemacs-preview-section-map
+                                'font-lock-face 'diff-file-header
+                                'mouse-face 'highlight
+                                'help-echo "mouse-2, RET: show changes")
+                    "\n")))
+        (diff-mode)
+        (buffer-disable-undo)
+        (setq buffer-read-only t)
+        (goto-char (point-min))))
+    (switch-to-buffer buffer)))
+
+(defun ropemacs-preview-toggle-section (&optional event)
+  "Show or hide the changes of the file at point in `*rope-preview*'."
+  (interactive (list last-nonmenu-event))
+  (when (mouse-event-p event)
+    (posn-set-point (event-end event)))
+  (let ((index (get-text-property (point) 'ropemacs-section))
+        (inhibit-read-only t))
+    (when index
+      (save-excursion
+        (forward-line 1)
+        (if (get-text-property (point) 'ropemacs-section-body)
+            (delete-region (point)
+                           (or (next-single-property-change
+                                (point) 'ropemacs-section-body)
+                               (point-max)))
+          (insert (propertize (rope-preview-section index)
+                              'ropemacs-section-body index)))))))
+
+(defun ropemacs--visited-files (files)
+  "Return the members of FILES visited by a buffer."
+  (let (result)
+    (dolist (file files (nreverse result))
+      (when (find-buffer-visiting file)
+        (push file result)))))
+
+(defun ropemacs--reload-buffers (updates)
+  "Update the buffers of files rope changed.
+
+UPDATES is a list of (FILE CONTENTS NEWNAME).  If NEWNAME is non-nil,
+FILE was moved to NEWNAME and is visited again there.  Otherwise the
+text of the buffer is replaced with CONTENTS if it is a string, or the
+buffer is reverted keeping its modes."
+  (let ((initial (current-buffer)))
+    (dolist (update updates)
+      (let ((buffer (find-buffer-visiting (nth 0 update)))
+            (contents (nth 1 update)))
+        (cond ((nth 2 update)
+               (when (eq buffer initial)
+                 (setq initial nil))
+               (kill-buffer buffer)
+               (find-file (nth 2 update)))
+              ((and contents (fboundp 'replace-buffer-contents))
+               (with-current-buffer buffer
+                 (let ((inhibit-read-only t)
+                       (source (generate-new-buffer " *rope-contents*")))
+                   (unwind-protect
+                       (progn
+                         (with-current-buffer source
+                           (insert contents))
+                         (replace-buffer-contents source))
+                     (kill-buffer source)))
+                 (set-buffer-modified-p nil)
+                 (set-visited-file-modtime)))
+              (t
+               (with-current-buffer buffer
+                 (revert-buffer t t t))))))
+    (when (buffer-live-p initial)
+      (set-buffer initial))))
+
+(defvar ropemacs--autoimport-timer nil
+  "The timer reporting the progress of `rope-generate-autoimport-cache'.")
+
+(defun ropemacs--autoimport-start ()
+  "Report the progress of generating autoimport cache until it is done."
+  (unless ropemacs--autoimport-timer
+    (setq ropemacs--autoimport-timer
+          (run-with-timer 0.5 0.5 'ropemacs--autoimport-poll))))
+
+(defun ropemacs--autoimport-poll ()
+  (when (rope-autoimport-poll)
+    (cancel-timer ropemacs--autoimport-timer)
+    (setq ropemacs--autoimport-timer nil)))
+
+(defun ropemacs--wait (seconds)
+  "Redisplay and wait SECONDS; return non-nil if the user quit."
+  (condition-case nil
+      (progn (sit-for seconds) nil)
+    (quit t)))
+
+(defun ropemacs--scoped-text (lines)
+  "Return the parts of the current buffer rope needs around point.
+
+Return nil if the buffer has less than LINES lines.  Otherwise
+return a list of (START LINE TEXT) for the top-level statement
+containing point and the top-level import statements, where START
+is the position and LINE the line number of TEXT."
+  (save-excursion
+    (save-restriction
+      (widen)
+      (when (>= (count-lines (point-min) (point-max)) lines)
+        (let* ((around (ropemacs--top-level-statement (point)))
+               (regions (list around)))
+          (goto-char (point-min))
+          (while (re-search-forward
+                  (rx bol (or "import" "from") (any " \\t")) nil t)
+            (let ((region (ropemacs--top-level-statement (point))))
+              (unless (equal region around)
+                (push region regions))
+              (goto-char (max (point) (cdr region)))))
+          (mapcar (lambda (region)
+                    (list (car region) (line-number-at-pos (car region))
+                          (buffer-substring-no-properties (car region)
+                                                          (cdr region))))
+                  regions))))))
+
+(defun ropemacs--top-level-statement (position)
+  "Return (START . END) of the top-level statement containing POSITION.
+
+Top-level statements start at lines that do not start with
+whitespace, `#' or a closing bracket; the decorators of a definition
+belong to it."
+  (save-excursion
+    (goto-char position)
+    (end-of-line)
+    (let ((start (or (ropemacs--top-level-search t) (point-min))))
+      (while (and (> start (point-min))
+                  (progn (goto-char (1- start))
+                         (ropemacs--top-level-search t))
+                  (eq (char-after) ?@))
+        (setq start (point)))
+      (goto-char start)
+      (while (and (eq (char-after) ?@)
+                  (progn (forward-line 1)
+                         (ropemacs--top-level-search nil 'move))))
+      (forward-line 1)
+      (cons start (or (ropemacs--top-level-search nil t) (point-max))))))
+
+(defun ropemacs--top-level-search (backward &optional noerror)
+  "Move to the next line that starts a top-level statement.
+
+Search backward if BACKWARD is non-nil.  Lines inside strings, like
+those of docstrings, are skipped.  Return the new point, or nil if
+there is no such line; NOERROR is as in `re-search-forward'."
+  (let ((top-level "^[^]} \\t\\n#)]")
+        (searching t)
+        found)
+    (while (and searching
+                (if backward
+                    (re-search-backward top-level nil noerror)
+                  (re-search-forward top-level nil noerror)))
+      (let ((start (match-beginning 0)))
+        (cond ((not (nth 8 (save-excursion (syntax-ppss start))))
+               (setq found (goto-char start)
+                     searching nil))
+              ((not backward))
+              ((> start (point-min))
+               (goto-char (1- start)))
+              (t (setq searching nil)))))
+    found))
+
+(defun ropemacs--completion-tables-p ()
+  "Return non-nil if `ropemacs-completing-read-function' takes tables.
+
+`ido-completing-read' needs the list of all choices, so it cannot
+use `ropemacs--read-candidate'."
+  (not (eq ropemacs-completing-read-function 'ido-completing-read)))
+
+(defun ropemacs--read-candidate (prompt function &rest args)
+  "Read one of the candidates rope finds for the input.
+
+FUNCTION is called with the input and ARGS whenever the input
+changes and returns the candidates matching it, best first.  The
+input is read with `ropemacs-completing-read-function'."
+  (let (last-input candidates)
+    (funcall
+     ropemacs-completing-read-function
+     prompt
+     (lambda (string pred action)
+       (if (eq action 'metadata)
+           '(metadata (display-sort-function . identity)
+                      (cycle-sort-function . identity))
+         (unless (and candidates (equal string last-input))
+           (setq last-input string
+                 candidates (apply function string args)))
+         (cond ((eq action t) candidates)
+               ((eq action 'lambda) (and (member string candidates) t))
+               ((null action)
+                (cond ((null candidates) nil)
+                      ((equal candidates (list string)) t)
+                      ((null (cdr candidates)) (car candidates))
+                      (t string))))))
+     nil t)))
+
+(defvar ropemacs--sync-counter 0
+  "The last version assigned to a buffer text.")
+(defvar-local ropemacs--sync-version nil
+  "The version of buffer text last sent to python.")
+(defvar-local ropemacs--sync-changes nil
+  "Changes made since `ropemacs--sync-version', newest first.")
+(defvar-local ropemacs--sync-tick nil
+  "The value of `buffer-chars-modified-tick' after the last recorded change.")
+
+(defun ropemacs--before-change (beg end)
+  ;; a change has been made while the hooks were inhibited
+  (unless (eq ropemacs--sync-tick (buffer-chars-modified-tick))
+    (setq ropemacs--sync-version nil)))
+
+(defun ropemacs--after-change (beg end old-len)
+  (when ropemacs--sync-version
+    (push (list beg old-len (buffer-substring-no-properties beg end))
+          ropemacs--sync-changes)
+    (setq ropemacs--sync-tick (buffer-chars-modified-tick))
+    (when (> (length ropemacs--sync-changes) 256)
+      (setq ropemacs--sync-version nil))))
+
+(defun ropemacs--sync-text (&optional full file)
+  "Return the changes made to the current buffer since the last call.
+
+The result is (VERSION BASE CHANGES SIZE), where CHANGES is the
+list of (START OLD-LENGTH TEXT) changes that turn the text of BASE
+version into VERSION.  When the changes are unknown or FULL is
+non-nil, BASE is nil and the whole text is returned instead; see
+`ropemacs--bulk-text' for FILE."
+  (let ((base (and (not full)
+                   (eq ropemacs--sync-tick (buffer-chars-modified-tick))
+                   ropemacs--sync-version))
+        (changes (nreverse ropemacs--sync-changes)))
+    (setq ropemacs--sync-counter (1+ ropemacs--sync-counter)
+          ropemacs--sync-version ropemacs--sync-counter
+          ropemacs--sync-changes nil
+          ropemacs--sync-tick (buffer-chars-modified-tick))
+    (if base
+        (list ropemacs--sync-version base changes (buffer-size))
+      (list ropemacs--sync-version nil (ropemacs--bulk-text file)
+            (buffer-size)))))
+
+(defun ropemacs--bulk-text (&optional file)
+  "Return the whole text of the current buffer.
+
+If FILE is non-nil and the buffer has at least
+`ropemacs-bulk-transport-size' characters, the text is written to
+FILE and nil is returned instead."
+  (if (and file ropemacs-bulk-transport-size
+           (>= (buffer-size) ropemacs-bulk-transport-size))
+      (let ((coding-system-for-write 'utf-8-unix))
+        (write-region nil nil file nil 'silent)
+        nil)
+    (save-restriction
+      (widen)
+      (buffer-substring-no-properties (point-min) (point-max)))))
+
+(defun ropemacs--bulk-read (file)
+  "Return the text ropemacs wrote to FILE and delete it."
+  (with-temp-buffer
+    (let ((coding-system-for-read 'utf-8-unix))
+      (insert-file-contents file))
+    (delete-file file)
+    (buffer-string)))
 
 (defun ropemacs-completion-at-point ()
   (unless (nth 8 (syntax-ppss))
@@ -618,14 +2995,56 @@ MINOR_MODE = """\
             :company-doc-buffer 'ropemacs--completion-doc-buffer
             :company-location 'ropemacs--completion-location))))
 
-(defalias 'ropemacs--completion-table
+(defun ropemacs--completion-table (string pred action)
+  "Complete STRING with rope; see `ropemacs--cached-completion-table'.
+
+Nothing is cached when computing completions in background is
+interrupted; see `ropemacs--async-completions'."
+  (catch 'ropemacs--interrupted
+    (ropemacs--cached-completion-table string pred action)))
+
+(defalias 'ropemacs--cached-completion-table
   (if (fboundp 'completion-table-with-cache)
       (completion-table-with-cache #'ropemacs--completion-candidates)
     (completion-table-dynamic #'ropemacs--completion-candidates)))
 
 (defun ropemacs--completion-candidates (prefix)
-  (mapcar (lambda (element) (concat prefix element))
-          (rope-completions)))
+  (let ((key (ropemacs--completion-key prefix)))
+    (if ropemacs-async-completions
+        (ropemacs--async-completions key prefix)
+      (rope-completion-candidates key prefix))))
+
+(defun ropemacs--completion-key (prefix)
+  "Return the key of the completions of PREFIX before point.
+
+The key contains the file name, the position of PREFIX and digests
+of the text before and after it; it stays the same while PREFIX is
+extended."
+  (let ((start (- (point) (length prefix))))
+    (save-restriction
+      (widen)
+      (list (buffer-file-name) start
+            (secure-hash 'md5 (current-buffer) (point-min) start)
+            (secure-hash 'md5 (current-buffer) (point) (point-max))))))
+
+(defun ropemacs--async-completions (key prefix)
+  "Return `rope-completion-candidates' computed in background.
+
+Throws `ropemacs--interrupted' if input arrives, point moves, the
+buffer is changed or a newer job replaces this one before they are
+ready."
+  (let ((job (rope-completions-start key prefix))
+        (tick (buffer-chars-modified-tick))
+        (start (point))
+        result)
+    (while (and (setq result (rope-completions-poll job))
+                (not (car result))
+                (sit-for 0.05)
+                (eq tick (buffer-chars-modified-tick))
+                (eq start (point))))
+    (if (car result)
+        (cadr result)
+      (throw 'ropemacs--interrupted nil))))
 
 (defun ropemacs--with-inserted (candidate fn)
   (let ((inhibit-modification-hooks t)
@@ -640,7 +3059,10 @@ MINOR_MODE = """\
        (set-buffer-modified-p modified-p))))
 
 (defun ropemacs--completion-doc-buffer (candidate)
-  (let ((doc (ropemacs--with-inserted candidate #'rope-get-doc)))
+  (let* ((resolved (rope-completion-doc candidate))
+         (doc (if (car resolved)
+                  (cadr resolved)
+                (ropemacs--with-inserted candidate #'rope-get-doc))))
     (when doc
       (with-current-buffer (get-buffer-create "*ropemacs-completion-doc*")
         (erase-buffer)
@@ -649,8 +3071,11 @@ MINOR_MODE = """\
         (current-buffer)))))
 
 (defun ropemacs--completion-location (candidate)
-  (let ((location (ropemacs--with-inserted
-                   candidate #'rope-definition-location)))
+  (let* ((resolved (rope-completion-location candidate))
+         (location (if (car resolved)
+                       (cadr resolved)
+                     (ropemacs--with-inserted
+                      candidate #'rope-definition-location))))
     (when location
       (cons (elt location 0) (elt location 1)))))
 """
@@ -664,18 +3089,74 @@ shortcuts = [('M-/', 'rope-code-assist'),
 
 
 _interface = None
+_profiler = None
+
+def load_interface():
+    """Import rope and define ropemacs commands
+
+    Used by `ropemacs--ensure-loaded'; does nothing if the commands
+    are already defined.
+    """
+    if _interface is None:
+        _load_interface()
+        commands = []
+        for name in _exported:
+            callback = globals()[name]
+            commands.append([_lisp_name(name), name,
+                             getattr(callback, 'interaction', None),
+                             callback.__doc__])
+        lisp.ropemacs__define_commands(commands)
+
+def call_command(name, *args):
+    """Call the ropemacs function `name'
+
+    Used by the commands `ropemacs--define-commands' defines.
+    """
+    return globals()[name](*args)
+
+def _load_interface():
+    global _interface
+    if _interface is None:
+        import ropemode.decorators
+        import ropemode.interface
+        ropemode.decorators.logger.message = message
+        mixins = (_ProjectResources, _BackgroundAutoimport, _IndexedFindFile,
+                  _IndexedGlobals, _PatchedReload, _ParallelOccurrences,
+                  _BackgroundAnalysis, _ScopedAnalysis)
+        for mixin in mixins:
+            for name, method in list(vars(mixin).items()):
+                if hasattr(method, 'decorator'):
+                    decorator, args, kwds = method.decorator
+                    decorator = getattr(ropemode.decorators, decorator)
+                    setattr(mixin, name, decorator(*args, **kwds)(method))
+        mode = type('RopeMode', mixins + (ropemode.interface.RopeMode,), {})
+        env = LispUtils()
+        with _key_bindings.collect(env, 'commands'):
+            _interface = mode(env=env)
+            _interface.init()
+
 
 def _load_ropemacs():
-    global _interface
-    ropemode.decorators.logger.message = message
+    global _profiler, lisp
     lisp(DEFVARS)
-    _interface = ropemode.interface.RopeMode(env=LispUtils())
-    _interface.init()
+    if LispUtils().get('profile_commands'):
+        _profiler = _Profiler()
+        lisp = _ProfilingLisp(lisp, _profiler)
     lisp(MINOR_MODE)
+    env = LispUtils()
+    _bulk.size = env.get('bulk_transport_size')
+    with _key_bindings.collect(env, 'startup'):
+        if env.get('lazy_load'):
+            if env.global_prefix:
+                _key_bindings.add(
+                    "(global-set-key %s 'ropemacs--load-from-global-prefix)" %
+                    _lisp_string(env._key_sequence(env.global_prefix)))
+        else:
+            _load_interface()
 
-    if LispUtils().get('enable_shortcuts'):
-        for key, command in shortcuts:
-            LispUtils()._bind_local(command, key)
+        if env.get('enable_shortcuts'):
+            for key, command in shortcuts:
+                env._bind_local(command, key)
 
     lisp.add_hook(lisp['python-mode-hook'], lisp['ropemacs-mode'])
 
@@ -0,0 +1,64 @@
+"""Functions ropemacs runs in worker processes
+
+Worker processes do not talk to emacs; this module does not use
+pymacs and imports rope only when its functions are called.
+"""
+
+
+def autoimport_names(root, underlined, paths, modules):
+    """Return the global names of the given files and modules
+
+    Runs in the worker processes of `ropemacs._AutoimportJob`.
+    """
+    import rope.base.project
+    from rope.contrib import autoimport
+    project = rope.base.project.Project(root)
+    cache = autoimport.AutoImport(project, observe=False,
+                                  underlined=underlined)
+    cache.names = {}
+    for path in paths:
+        cache.update_resource(project.get_resource(path))
+    cache.generate_modules_cache(modules)
+    return cache.names
+
+
+def occurrences_in(root, search, path, offset, unsure, in_hierarchy, paths):
+    """Return the occurrences of the name at `offset` of `path` in `paths`
+
+    Runs in the worker processes of `ropemacs._OccurrencesSearch`.
+    The finder is kept for the later chunks of the same search and the
+    project, with the modules rope has analyzed, for later searches;
+    it is validated when a search starts, so that changed modules are
+    analyzed again.  Occurrences are (PATH OFFSET UNSURE LINENO)
+    tuples.
+    """
+    global _project, _finder
+    if _finder is None or _finder[0] != search:
+        import rope.base.project
+        from rope.base import evaluate, worder
+        from rope.refactor import occurrences
+        project = _project
+        if project is None or project.address != root:
+            project = rope.base.project.Project(root)
+            _project = project
+        else:
+            project.validate(project.root)
+        resource = project.get_resource(path)
+        primary, pyname = evaluate.eval_location2(
+            project.get_pymodule(resource), offset)
+        finder = occurrences.create_finder(
+            project, worder.get_name_at(resource, offset), pyname,
+            unsure=lambda occurrence: unsure, in_hierarchy=in_hierarchy,
+            instance=primary)
+        _finder = (search, finder)
+    project = _project
+    finder = _finder[1]
+    result = []
+    for path in paths:
+        for occurrence in finder.find_occurrences(project.get_resource(path)):
+            result.append((path, occurrence.get_word_range()[0],
+                           occurrence.is_unsure(), occurrence.lineno))
+    return result
+
+_project = None
+_finder = None
@@ -1,7 +1,10 @@
 extra_kwargs = {}
 try:
     from setuptools import setup
-    extra_kwargs['install_requires'] = ['rope >= 0.9.4', 'ropemode >= 0.2']
+    extra_kwargs['install_requires'] = ['rope >= 0.9.4',
+                                        'ropemode >= 0.6, < 0.7']
+    # for cancel_futures of Executor.shutdown()
+    extra_kwargs['python_requires'] = '>=3.9'
 except ImportError:
     from distutils.core import setup
 
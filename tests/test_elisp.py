@@ -0,0 +1,142 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import ropemacs
+
+
+@unittest.skipIf(shutil.which('emacs') is None, 'emacs is not installed')
+class ElispTest(unittest.TestCase):
+    """Run the lisp ropemacs defines in `emacs --batch`"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.definitions = os.path.join(self.folder, 'ropemacs-defs.el')
+        with open(self.definitions, 'w') as output:
+            output.write(ropemacs.DEFVARS + ropemacs.MINOR_MODE)
+
+    def run_lisp(self, source):
+        test = os.path.join(self.folder, 'test.el')
+        with open(test, 'w') as output:
+            output.write(source)
+        process = subprocess.run(
+            ['emacs', '--batch', '-Q', '-l', self.definitions, '-l', test],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(0, process.returncode, process.stdout.decode())
+
+    def test_definitions_compile(self):
+        self.run_lisp('''
+(with-current-buffer (find-file-noselect %s)
+  (check-parens))
+(unless (byte-compile-file %s)
+  (error "Byte compilation failed"))
+''' % (_lisp_text(self.definitions), _lisp_text(self.definitions)))
+
+    def test_top_level_statement(self):
+        source = 'import os\nx = [\n    1,\n]\ndef f():\n    pass\n'
+        inside = source.index('1,') + 1
+        start = source.index('x') + 1
+        end = source.index('def') + 1
+        self.run_lisp('''
+(with-temp-buffer
+  (insert %s)
+  (let ((region (ropemacs--top-level-statement %d)))
+    (unless (equal region '(%d . %d))
+      (error "Wrong statement: %%S" region))))
+''' % (_lisp_text(source), inside, start, end))
+
+    def test_lines_in_strings(self):
+        source = ('import os\ndef f():\n    """Doc\nat column 0\n    """\n'
+                  '    x = 1\ndef g():\n    pass\n')
+        inside = source.index('x = 1') + 1
+        start = source.index('def f') + 1
+        end = source.index('def g') + 1
+        self.run_lisp('''
+(with-temp-buffer
+  (python-mode)
+  (insert %s)
+  (let ((region (ropemacs--top-level-statement %d)))
+    (unless (equal region '(%d . %d))
+      (error "Wrong statement: %%S" region))))
+''' % (_lisp_text(source), inside, start, end))
+
+    def test_scoped_text(self):
+        source = 'import os\n\n\ndef f():\n    os.\n\n\ndef g():\n    pass\n'
+        point = source.index('os.') + 4
+        function = source.index('def f')
+        end = source.index('def g')
+        expected = '((1 1 %s) (%d 4 %s))' % (
+            _lisp_text(source[:function]), function + 1,
+            _lisp_text(source[function:end]))
+        self.run_lisp('''
+(with-temp-buffer
+  (insert %s)
+  (goto-char %d)
+  (let ((segments (ropemacs--scoped-text 1)))
+    (unless (equal (sort segments (lambda (a b) (< (car a) (car b))))
+                   '%s)
+      (error "Wrong segments: %%S" segments))))
+''' % (_lisp_text(source), point, expected))
+
+    def test_old_key_bindings_are_deleted(self):
+        old = ['ropemacs-keys-commands-0123456789abcdef.el',
+               'ropemacs-keys-commands-0123456789abcdef.elc',
+               'ropemacs-keys-startup-0123456789abcdef.el']
+        for name in old:
+            open(os.path.join(self.folder, name), 'w').close()
+        self.run_lisp('''
+(setq user-emacs-directory %s)
+(ropemacs--save-key-bindings "ropemacs-keys-commands-fedcba9876543210"
+                             "(defvar test-key-bindings t)")
+''' % _lisp_text(self.folder + '/'))
+        self.assertEqual(
+            ['ropemacs-keys-commands-fedcba9876543210.el',
+             'ropemacs-keys-commands-fedcba9876543210.elc',
+             'ropemacs-keys-startup-0123456789abcdef.el'],
+            sorted(name for name in os.listdir(self.folder)
+                   if name.startswith('ropemacs-keys-')))
+
+    def test_interrupted_completions_are_not_cached(self):
+        self.run_lisp('''
+(require 'cl-lib)
+(defvar test-done nil)
+(defun rope-completions-start (key prefix) 1)
+(defun rope-completions-poll (job)
+  (if test-done '(t ("grow")) '(nil nil)))
+(with-temp-buffer
+  (insert "widget.gr")
+  (let ((ropemacs-async-completions t))
+    (cl-letf (((symbol-function 'sit-for) (lambda (&rest args) nil)))
+      (when (ropemacs--completion-table "gr" nil t)
+        (error "Completions while interrupted")))
+    (setq test-done t)
+    (unless (equal (ropemacs--completion-table "gr" nil t) '("grow"))
+      (error "Interrupted completions were cached"))))
+''')
+
+    def test_replaced_completions_are_not_cached(self):
+        self.run_lisp('''
+(defvar test-replaced t)
+(defun rope-completions-start (key prefix) 1)
+(defun rope-completions-poll (job)
+  (if test-replaced nil '(t ("grow"))))
+(with-temp-buffer
+  (insert "widget.gr")
+  (let ((ropemacs-async-completions t))
+    (when (ropemacs--completion-table "gr" nil t)
+      (error "Completions of a replaced job"))
+    (setq test-replaced nil)
+    (unless (equal (ropemacs--completion-table "gr" nil t) '("grow"))
+      (error "Completions of a replaced job were cached"))))
+''')
+
+
+def _lisp_text(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+if __name__ == '__main__':
+    unittest.main()
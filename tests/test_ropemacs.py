@@ -0,0 +1,494 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import rope.base.change
+import rope.base.project
+
+import ropemacs
+
+
+class BufferShadowsTest(unittest.TestCase):
+
+    text = 'first\nsecond\n'
+
+    def apply(self, *changes):
+        changes = list(changes)
+        text = self.text
+        for start, length, inserted in changes:
+            text = text[:start - 1] + inserted + text[start - 1 + length:]
+        return ropemacs._BufferShadows()._apply(self.text, changes, len(text))
+
+    def test_insert(self):
+        self.assertEqual('>first\nsecond\n', self.apply([1, 0, '>']))
+        self.assertEqual('first\n>second\n', self.apply([7, 0, '>']))
+        self.assertEqual('first\nsecond\n>', self.apply([14, 0, '>']))
+
+    def test_delete(self):
+        self.assertEqual('irst\nsecond\n', self.apply([1, 1, '']))
+        self.assertEqual('firstsecond\n', self.apply([6, 1, '']))
+        self.assertEqual('first\nsecond', self.apply([13, 1, '']))
+
+    def test_replace(self):
+        self.assertEqual('1st\nsecond\n', self.apply([1, 5, '1st']))
+        self.assertEqual('first\n2nd\n', self.apply([7, 6, '2nd']))
+        self.assertEqual('first\nsecond.', self.apply([13, 1, '.']))
+
+    def test_several_changes(self):
+        self.assertEqual('1st\n\nsecond line\n', self.apply(
+            [1, 5, '1st'], [5, 0, '\n'], [12, 0, ' line']))
+
+    def test_wrong_size(self):
+        self.assertIsNone(ropemacs._BufferShadows()._apply(
+            self.text, [[1, 0, '>']], len(self.text)))
+
+    def test_unknown_text(self):
+        self.assertIsNone(ropemacs._BufferShadows()._apply(
+            None, [[1, 0, '>']], len(self.text) + 1))
+
+
+class LineIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ropemacs._LineIndex('first\nsecond\n\nlast')
+
+    def test_lines(self):
+        self.assertEqual('first\n', self.index.line(1))
+        self.assertEqual('second\n', self.index.line(2))
+        self.assertEqual('\n', self.index.line(3))
+        self.assertEqual('last', self.index.line(4))
+
+    def test_lines_out_of_range(self):
+        self.assertEqual('', self.index.line(0))
+        self.assertEqual('', self.index.line(5))
+
+    def test_lineno_and_offset(self):
+        self.assertEqual(1, self.index.lineno(0))
+        self.assertEqual(1, self.index.lineno(5))
+        self.assertEqual(2, self.index.lineno(6))
+        self.assertEqual(4, self.index.lineno(len('first\nsecond\n\nla')))
+        self.assertEqual(6, self.index.offset(2))
+        self.assertEqual(14, self.index.offset(4))
+
+    def test_text_ending_with_newline(self):
+        index = ropemacs._LineIndex('one\ntwo\n')
+        self.assertEqual('two\n', index.line(2))
+        self.assertEqual('', index.line(3))
+
+
+class AsyncCompletionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.completions = ropemacs._AsyncCompletions()
+        self.completions.latest = 2
+
+    def test_finished_jobs(self):
+        self.completions.results = {2: (['grow'], None)}
+        self.assertEqual([True, ['grow']], self.completions.poll(2))
+
+    def test_running_jobs(self):
+        self.assertEqual([False, None], self.completions.poll(2))
+
+    def test_replaced_jobs(self):
+        self.assertIsNone(self.completions.poll(1))
+
+
+class ProjectTest(unittest.TestCase):
+
+    files = {}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path, text in self.files.items():
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as output:
+                output.write(text)
+        self.project = rope.base.project.Project(self.root, ropefolder=None)
+
+    def tearDown(self):
+        self.project.close()
+        shutil.rmtree(self.root)
+
+
+class FileIndexTest(ProjectTest):
+
+    files = {'pkg/__init__.py': '', 'pkg/module.py': '',
+             'pkg/data/module.txt': '', 'other.py': ''}
+
+    def setUp(self):
+        super().setUp()
+        self.index = ropemacs._FileIndex(self.project)
+
+    def test_names(self):
+        self.assertEqual('module.py<pkg', ropemacs._FileIndex.name(
+            'pkg/module.py'))
+        self.assertEqual('pkg/module.py', ropemacs._FileIndex.path(
+            'module.py<pkg'))
+
+    def test_closest_matches_first(self):
+        self.assertEqual(['module.py<pkg', 'module.txt<data<pkg'],
+                         self.index.match('module'))
+        self.assertEqual(['other.py', 'module.txt<data<pkg'],
+                         self.index.match('ot'))
+
+    def test_python_only(self):
+        self.assertEqual(['module.py<pkg'],
+                         self.index.match('module', python_only=True))
+
+    def test_narrowing_pattern(self):
+        self.assertEqual(4, len(self.index.match('')))
+        self.assertEqual(['other.py'], self.index.match('oth'))
+        self.assertEqual([], self.index.match('othx'))
+
+    def test_created_files(self):
+        self.index.match('mod')
+        self.project.get_folder('pkg').create_file('model.py')
+        self.assertIn('model.py<pkg', self.index.match('mod'))
+
+    def test_removed_files(self):
+        self.index.match('mod')
+        self.project.get_file('pkg/module.py').remove()
+        self.assertEqual(['module.txt<data<pkg'], self.index.match('module'))
+
+    def test_limit(self):
+        self.index.limit = 1
+        self.assertEqual(['module.py<pkg'], self.index.match('module'))
+
+
+class _AutoImport(object):
+
+    def __init__(self, names):
+        self.names = names
+
+    def _module_name(self, resource):
+        return resource.path[:-3].replace('/', '.')
+
+
+class GlobalIndexTest(ProjectTest):
+
+    def setUp(self):
+        super().setUp()
+        self.autoimport = _AutoImport({
+            'first': ['parse', 'parse_args', 'Parser'],
+            'second': ['parse', 'print_all', 'unparse'],
+        })
+        self.index = ropemacs._GlobalIndex(self.project, self.autoimport)
+
+    def test_prefixes_first(self):
+        self.assertEqual(['parse', 'parse_args', 'unparse'],
+                         self.index.match('pars'))
+
+    def test_characters_in_order(self):
+        self.assertEqual(['parse', 'parse_args', 'unparse'],
+                         self.index.match('prs'))
+        self.assertEqual(['print_all'], self.index.match('pl'))
+
+    def test_case_sensitive(self):
+        self.assertEqual(['Parser'], self.index.match('Pa'))
+
+    def test_limit(self):
+        self.index.limit = 2
+        self.assertEqual(['parse', 'print_all'], self.index.match('p'))
+
+    def test_changed_modules(self):
+        self.index.match('')
+        resource = self.project.root.create_file('second.py')
+        self.autoimport.names['second'] = ['parse', 'prepare']
+        self.index._changed(resource)
+        self.assertEqual(['prepare'], self.index.match('prep'))
+        self.assertEqual([], self.index.match('unparse'))
+        self.assertEqual(['first', 'second'], self.index.modules['parse'])
+
+
+class AnalysisQueueTest(ProjectTest):
+
+    files = {'first.py': '', 'second.py': ''}
+
+    def setUp(self):
+        super().setUp()
+        interface = mock.Mock(project=self.project)
+        interface.env.path_on_python_host.side_effect = lambda path: path
+        self.queue = ropemacs._AnalysisQueue(interface)
+        for path in ('first.py', 'second.py'):
+            self.queue.pending[path] = (0, self.project, None,
+                                        self.project.get_resource(path))
+
+    def test_current_file_first(self):
+        self.assertEqual(':2', self.queue.status(
+            os.path.join(self.root, 'second.py')))
+        self.assertEqual('second.py', self.queue._next())
+
+    def test_files_outside_the_project(self):
+        self.queue.status('/elsewhere/second.py')
+        self.assertEqual('first.py', self.queue._next())
+
+
+class ChangedContentsTest(ProjectTest):
+
+    files = {'first.py': 'a = 1\n', 'second.py': 'b = 1\n'}
+
+    def setUp(self):
+        super().setUp()
+        first = self.project.get_resource('first.py')
+        second = self.project.get_resource('second.py')
+        self.changes = rope.base.change.ChangeSet('Change a and b')
+        for resource, text in [(first, 'a = 2\n'), (second, 'b = 2\n'),
+                               (first, 'a = 3\n')]:
+            self.changes.add_change(
+                rope.base.change.ChangeContents(resource, text))
+        self.project.do(self.changes)
+
+    def contents(self, undo=False):
+        return dict((resource.path, text) for resource, text in
+                    ropemacs._changed_contents(self.changes, undo).items())
+
+    def files_on_disk(self):
+        return dict((resource.path, resource.read())
+                    for resource in self.project.get_files())
+
+    def test_changes(self):
+        self.assertEqual({'first.py': 'a = 3\n', 'second.py': 'b = 2\n'},
+                         self.contents())
+        self.assertEqual(self.files_on_disk(), self.contents())
+
+    def test_undo(self):
+        self.project.history.undo()
+        self.assertEqual({'first.py': 'a = 1\n', 'second.py': 'b = 1\n'},
+                         self.contents(undo=True))
+        self.assertEqual(self.files_on_disk(), self.contents(undo=True))
+
+
+class MemoryGovernorTest(ProjectTest):
+
+    # 600 characters, 45000 bytes when analyzed
+    files = dict(('mod%d.py' % index, 'x = 1\n' * 100)
+                 for index in range(5))
+
+    def setUp(self):
+        super().setUp()
+        # three modules fit; two are kept after shrinking
+        self.governor = ropemacs._MemoryGovernor(self.project, 0.15)
+        self.governor.install()
+        self.modules = [self.project.get_resource('mod%d.py' % index)
+                        for index in range(5)]
+
+    def analyze(self, *indexes):
+        for index in indexes:
+            self.project.get_pymodule(self.modules[index])
+
+    def trim(self, *visited):
+        visited = set(self.modules[index] for index in visited)
+        with mock.patch.object(self.governor, '_visited',
+                               return_value=visited):
+            self.governor.trim()
+
+    def kept(self):
+        return sorted(resource.path for resource in
+                      self.project.pycore.module_cache.module_map)
+
+    def test_within_budget(self):
+        self.analyze(0, 1, 2)
+        self.trim()
+        self.assertEqual(['mod0.py', 'mod1.py', 'mod2.py'], self.kept())
+        self.assertEqual(0, self.governor.evicted)
+
+    def test_least_recently_used_first(self):
+        self.analyze(0, 1, 2, 3, 0)
+        self.trim()
+        self.assertEqual(['mod0.py', 'mod3.py'], self.kept())
+        self.assertEqual(2, self.governor.evicted)
+        self.assertEqual(90000, self.governor.total)
+
+    def test_visited_files_are_kept(self):
+        self.analyze(0, 1, 2, 3, 4)
+        self.trim(0, 1)
+        self.assertEqual(['mod0.py', 'mod1.py', 'mod4.py'], self.kept())
+
+    def test_dropped_modules_are_analyzed_again(self):
+        self.analyze(0, 1, 2, 3)
+        self.trim()
+        self.analyze(0)
+        self.assertIn('mod0.py', self.kept())
+        self.assertEqual(list(self.governor.modules)[-1], self.modules[0])
+
+
+class DiffSectionsTest(unittest.TestCase):
+
+    diffs = ('Renaming <shared> to <value>:\n\n'
+             '--- a/first.py\n+++ b/first.py\n'
+             '@@ -1,2 +1,2 @@\n-shared()\n+value()\n-shared\n+value\n'
+             '--- a/pkg/second.py\n+++ b/pkg/second.py\n'
+             '@@ -3 +3 @@\n+value = 1\n')
+
+    def setUp(self):
+        self.sections = ropemacs._DiffSections(self.diffs)
+
+    def test_header(self):
+        self.assertEqual('Renaming <shared> to <value>:\n\n',
+                         self.sections.header())
+
+    def test_summary(self):
+        self.assertEqual([['first.py  +2 -2', 0],
+                          ['pkg/second.py  +1 -0', 1]],
+                         self.sections.summary())
+
+    def test_sections(self):
+        self.assertTrue(self.sections.section(0).startswith('--- a/first.py'))
+        self.assertTrue(self.sections.section(1).endswith('+value = 1\n'))
+        self.assertEqual(self.diffs, self.sections.header() +
+                         self.sections.section(0) + self.sections.section(1))
+
+    def test_other_lines(self):
+        diffs = ('Move <pkg> to <lib>:\n\n\n'
+                 'rename from pkg/first.py\nrename to lib/first.py\n\n'
+                 'diff a/second.py b/second.py\n'
+                 '--- a/second.py\n+++ b/second.py\n'
+                 '@@ -1 +1 @@\n-import pkg\n+import lib\n\n'
+                 'rename from pkg/third.py\nrename to lib/third.py\n')
+        sections = ropemacs._DiffSections(diffs)
+        self.assertEqual(
+            'Move <pkg> to <lib>:\n\n\n'
+            'rename from pkg/first.py\nrename to lib/first.py\n\n',
+            sections.header())
+        self.assertEqual(
+            [['second.py  +1 -1', 0],
+             ['\nrename from pkg/third.py\nrename to lib/third.py\n', None]],
+            sections.summary())
+        self.assertEqual('diff a/second.py b/second.py\n--- a/second.py\n'
+                         '+++ b/second.py\n@@ -1 +1 @@\n'
+                         '-import pkg\n+import lib\n', sections.section(0))
+
+    def test_no_diffs(self):
+        sections = ropemacs._DiffSections('Move <pkg> to <lib>:\n')
+        self.assertEqual('Move <pkg> to <lib>:\n', sections.header())
+        self.assertEqual([], sections.summary())
+
+
+class _Lisp(object):
+    """Evaluate the calls `_PathTranslator` batches"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.round_trips = 0
+
+    def __getitem__(self, name):
+        return name
+
+    def call(self, function, args):
+        if function == 'mapcar':
+            return [self.call(args[0], [arg]) for arg in args[1]]
+        if function == 'symbol-value' and args[0] == 'default-directory':
+            return self.directory
+        if function == 'file-remote-p':
+            if args[0].startswith('/ssh:host:'):
+                return '/ssh:host:'
+            return None
+        raise LookupError('unexpected lisp call: %s' % function)
+
+
+class _LispBatch(object):
+
+    def __init__(self, lisp):
+        self.lisp = lisp
+        self.calls = []
+
+    def call(self, function, *args, **kwds):
+        ref = ropemacs._LispRef('r%d' % len(self.calls))
+        self.calls.append((ref, function, args))
+        return ref
+
+    def send(self):
+        self.lisp.round_trips += 1
+        for ref, function, args in self.calls:
+            args = [arg.value if isinstance(arg, ropemacs._LispRef) else arg
+                    for arg in args]
+            ref.value = self.lisp.call(function, args)
+
+
+class PathTranslatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lisp = _Lisp('/ssh:host:/home/user/')
+        for name, value in [('lisp', self.lisp),
+                            ('_LispBatch', lambda: _LispBatch(self.lisp))]:
+            patcher = mock.patch.object(ropemacs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.paths = ropemacs._PathTranslator()
+
+    def test_on_python_host(self):
+        self.assertEqual(['/home/user/a.py', '/tmp/b.py'],
+                         self.paths.on_python_host(
+                             ['/ssh:host:/home/user/a.py', '/tmp/b.py']))
+
+    def test_prefixes_of_folders_are_kept(self):
+        self.paths.on_python_host(['/ssh:host:/home/user/a.py'])
+        round_trips = self.lisp.round_trips
+        self.assertEqual(['/home/user/b.py'], self.paths.on_python_host(
+            ['/ssh:host:/home/user/b.py']))
+        self.assertEqual(round_trips, self.lisp.round_trips)
+
+    def test_on_lisp_host(self):
+        self.assertEqual(['/ssh:host:/home/user/a.py',
+                          '/ssh:host:/home/user/pkg/b.py'],
+                         self.paths.on_lisp_host(
+                             ['/home/user/a.py', 'pkg/b.py']))
+
+    def test_local_files(self):
+        self.lisp.directory = '/home/user/'
+        self.assertEqual(['/home/user/a.py'],
+                         self.paths.on_lisp_host(['a.py']))
+
+
+class ScopedSourceTest(unittest.TestCase):
+
+    source = ('import os\n'
+              'x = [\n'
+              '    1,\n'
+              ']\n'
+              'def f():\n'
+              '    pass\n')
+
+    def _segment(self, start, end):
+        return [start + 1, self.source.count('\n', 0, start) + 1,
+                self.source[start:end]]
+
+    def test_offsets_and_lines_are_kept(self):
+        start = self.source.index('def')
+        result = ropemacs._scoped_source([
+            self._segment(start, len(self.source)), self._segment(0, 10)])
+        self.assertEqual(len(self.source), len(result))
+        self.assertEqual(self.source.count('\n'), result.count('\n'))
+        self.assertEqual(self.source[start:], result[start:])
+        self.assertEqual('import os\n', result[:10])
+        self.assertEqual('', result[10:start].strip())
+
+    def test_overlapping_segments(self):
+        result = ropemacs._scoped_source([
+            self._segment(0, 14), self._segment(10, len(self.source)),
+            self._segment(0, 10)])
+        self.assertEqual(self.source, result)
+
+    def test_contained_segments(self):
+        result = ropemacs._scoped_source([
+            self._segment(0, len(self.source)), self._segment(10, 16)])
+        self.assertEqual(self.source, result)
+
+
+class LispStringTest(unittest.TestCase):
+
+    def test_control_characters(self):
+        self.assertEqual(r'"\C-c\C-z"', ropemacs._lisp_string('\x03\x1a'))
+        self.assertEqual(r'"\000\033\037"',
+                         ropemacs._lisp_string('\x00\x1b\x1f'))
+
+    def test_meta_and_escapes(self):
+        self.assertEqual(r'"\M-x\M-\C-a\"\\"',
+                         ropemacs._lisp_string('\xf8\x81"\\'))
+
+
+if __name__ == '__main__':
+    unittest.main()